@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+
+"""Benchmark of the download, import and rendering pipeline.
+
+Synthetic data (.osm extracts, SRTM .hgt tiles and shapefile archives) is
+generated and served from a local HTTP server. The stages then run the
+regular bundles against a separate benchmark project, so that numbers can be
+compared between configurations without hitting the real servers.
+
+The import, contours and seed stages use the tools built in the project
+containing osm-server-setup and its database (tables are prefixed with
+"bench_"). The seed stage renders the configured layers into a separate tile
+cache.
+"""
+
+__author__ = "Sylvain Pasche <sylvain.pasche@gmail.com>"
+
+import array
+import BaseHTTPServer
+import bz2
+import datetime
+import json
+import logging
+import math
+import optparse
+import os
+from os.path import join
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import struct
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+
+import main
+from main import find_executable, maybe_unlink
+
+log = logging.getLogger("benchmark")
+
+STAGES = ["download", "extract", "srtm_download", "import", "contours", "seed"]
+# Stages which need the data produced by other stages.
+PREREQUISITES = {
+    "extract": ["download"],
+    "import": ["download"],
+    "contours": ["srtm_download"],
+}
+DEFAULT_STAGES = ["download", "extract", "srtm_download"]
+
+BENCH_OSM_PREFIX = "bench_osm"
+
+
+# Synthetic data
+
+def write_osm(path, extent, nodes, first_id):
+    """Write a bzip2 compressed .osm file with a grid of about nodes nodes
+    covering extent, connected by highways, with a building every ten cells.
+
+    Returns the number of nodes written.
+    """
+    minx, miny, maxx, maxy = extent
+    side = max(2, int(math.sqrt(nodes)))
+
+    def node_id(row, col):
+        return first_id + row * side + col
+
+    f = bz2.BZ2File(path, "w")
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<osm version="0.6" generator="osm-server-setup benchmark">\n')
+    for row in range(side):
+        lat = miny + (maxy - miny) * row / (side - 1)
+        f.write("".join(
+            '<node id="%d" lat="%.7f" lon="%.7f" version="1"/>\n' % (
+                node_id(row, col), lat,
+                minx + (maxx - minx) * col / (side - 1))
+            for col in range(side)))
+
+    way_id = first_id
+    for row in range(side):
+        for start in range(0, side - 1, 10):
+            refs = range(start, min(start + 11, side))
+            f.write('<way id="%d" version="1">\n%s'
+                '<tag k="highway" v="residential"/>\n'
+                '<tag k="name" v="Street %d"/>\n</way>\n' % (
+                way_id,
+                "".join('<nd ref="%d"/>\n' % node_id(row, c) for c in refs),
+                way_id))
+            way_id += 1
+    for row in range(0, side - 1, 10):
+        for col in range(0, side - 1, 10):
+            refs = [node_id(row, col), node_id(row + 1, col),
+                node_id(row + 1, col + 1), node_id(row, col + 1),
+                node_id(row, col)]
+            f.write('<way id="%d" version="1">\n%s'
+                '<tag k="building" v="yes"/>\n</way>\n' % (
+                way_id, "".join('<nd ref="%d"/>\n' % r for r in refs)))
+            way_id += 1
+    f.write("</osm>\n")
+    f.close()
+    return side * side
+
+def get_hgt_name(lat, lon):
+    return "%s%02d%s%03d.hgt" % (
+        "N" if lat >= 0 else "S", abs(lat),
+        "E" if lon >= 0 else "W", abs(lon))
+
+def write_hgt_zip(path, lat, lon, size=1201):
+    """Write a zipped SRTM tile with hilly synthetic terrain."""
+    xs = [math.sin((lon + float(col) / size) * 40) for col in range(size)]
+    data = array.array("h")
+    for row in range(size):
+        y = math.cos((lat + 1 - float(row) / size) * 30)
+        data.extend([int(1000 + 800 * x * y) for x in xs])
+    # .hgt files are big endian.
+    if sys.byteorder == "little":
+        data.byteswap()
+    zipf = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+    zipf.writestr(get_hgt_name(lat, lon), data.tostring())
+    zipf.close()
+
+WGS84_PRJ = ('GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",'
+    '6378137,298.257223563]],PRIMEM["Greenwich",0],'
+    'UNIT["Degree",0.017453292519943295]]')
+
+def write_shapefile(base, extent, count):
+    """Write a polygon shapefile (base.shp, .shx, .dbf and .prj) with count
+    squares within extent."""
+    minx, miny, maxx, maxy = extent
+    side = max(1, int(math.ceil(math.sqrt(count))))
+    cell_x = (maxx - minx) / side
+    cell_y = (maxy - miny) / side
+
+    def header(file_words):
+        return (struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_words) +
+            struct.pack("<2i", 1000, 5) +
+            struct.pack("<8d", minx, miny, maxx, maxy, 0, 0, 0, 0))
+
+    # Polygon with one ring of 5 points.
+    content_words = (4 + 32 + 4 + 4 + 4 + 5 * 16) / 2
+    shp = open(base + ".shp", "wb")
+    shx = open(base + ".shx", "wb")
+    shp.write(header(50 + count * (4 + content_words)))
+    shx.write(header(50 + count * 4))
+    offset = 50
+    for i in range(count):
+        x0 = minx + (i % side) * cell_x
+        y0 = miny + (i / side) * cell_y
+        x1, y1 = x0 + cell_x * 0.8, y0 + cell_y * 0.8
+        shp.write(struct.pack(">2i", i + 1, content_words))
+        shp.write(struct.pack("<i4d2ii", 5, x0, y0, x1, y1, 1, 5, 0))
+        for x, y in ((x0, y0), (x0, y1), (x1, y1), (x1, y0), (x0, y0)):
+            shp.write(struct.pack("<2d", x, y))
+        shx.write(struct.pack(">2i", offset, content_words))
+        offset += 4 + content_words
+    shp.close()
+    shx.close()
+
+    today = datetime.date.today()
+    dbf = open(base + ".dbf", "wb")
+    dbf.write(struct.pack("<4BIHH20x", 3, today.year - 1900, today.month,
+        today.day, count, 32 + 32 + 1, 1 + 10))
+    dbf.write(struct.pack("<11sc4xBB14x", "id", "N", 10, 0))
+    dbf.write("\r")
+    for i in range(count):
+        dbf.write(" %10d" % (i + 1))
+    dbf.write("\x1a")
+    dbf.close()
+
+    open(base + ".prj", "wb").write(WGS84_PRJ)
+
+
+# Local HTTP server
+
+class QuietHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        # Serve the server root instead of the current directory.
+        path = SimpleHTTPServer.SimpleHTTPRequestHandler.translate_path(
+            self, path)
+        return join(self.server.root, os.path.relpath(path, os.getcwd()))
+
+    def log_message(self, format, *args):
+        log.debug("HTTP: " + format, *args)
+
+class LocalHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, root):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ("127.0.0.1", 0), QuietHTTPRequestHandler)
+        self.root = root
+        self.address = "127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+
+# Benchmark
+
+class Benchmark(object):
+    def __init__(self, options, work_dir, real_project_dir):
+        self.options = options
+        self.work_dir = work_dir
+        self.real_project_dir = real_project_dir
+        self.www_dir = join(work_dir, "www")
+        self.project_dir = join(work_dir, "project")
+        extent = [float(c) for c in options.extent.split(",")]
+        self.extent = tuple(extent)
+
+        self.osm_urls = []
+        self.archive_urls = []
+        self.nodes = 0
+        self.srtm_tiles = []
+
+    def _generate_data(self, base_url):
+        """Generate the synthetic data (if the parameters changed)."""
+        o = self.options
+        params = [self.extent, o.nodes, o.osm_files, o.features]
+        params_file = join(self.www_dir, "params.json")
+        generate = True
+        if os.path.isfile(params_file):
+            generate = json.load(open(params_file)) != json.loads(
+                json.dumps(params))
+        if generate:
+            maybe_unlink(self.www_dir)
+            os.makedirs(join(self.www_dir, "srtm", "Eurasia"))
+
+        minx, miny, maxx, maxy = self.extent
+        band = (maxy - miny) / o.osm_files
+        for i in range(o.osm_files):
+            filename = "bench_%d.osm.bz2" % i
+            band_extent = (minx, miny + i * band, maxx, miny + (i + 1) * band)
+            if generate:
+                log.info("Generating %s", filename)
+                write_osm(join(self.www_dir, filename), band_extent,
+                    o.nodes / o.osm_files, 1 + i * 10 ** 9)
+            self.osm_urls.append(base_url + filename)
+        side = max(2, int(math.sqrt(o.nodes / o.osm_files)))
+        self.nodes = side * side * o.osm_files
+
+        if generate:
+            log.info("Generating shapefiles")
+            shapes_dir = join(self.work_dir, "shapes")
+            maybe_unlink(shapes_dir)
+            os.makedirs(shapes_dir)
+            write_shapefile(join(shapes_dir, "bench_shapes"), self.extent,
+                o.features)
+            names = sorted(os.listdir(shapes_dir))
+            for filename, mode in (("bench_shapes.tar.bz2", "w:bz2"),
+                ("bench_shapes.tgz", "w:gz")):
+                tar = tarfile.open(join(self.www_dir, filename), mode)
+                for name in names:
+                    tar.add(join(shapes_dir, name), name)
+                tar.close()
+            zipf = zipfile.ZipFile(join(self.www_dir, "bench_shapes.zip"),
+                "w", zipfile.ZIP_DEFLATED)
+            for name in names:
+                zipf.write(join(shapes_dir, name), name)
+            zipf.close()
+        for filename in ("bench_shapes.tar.bz2", "bench_shapes.tgz",
+            "bench_shapes.zip"):
+            self.archive_urls.append(base_url + filename)
+
+        for lon in range(int(math.floor(minx)), int(math.ceil(maxx))):
+            for lat in range(int(math.floor(miny)), int(math.ceil(maxy))):
+                self.srtm_tiles.append((lat, lon))
+                if generate:
+                    log.info("Generating SRTM tile %s, %s", lat, lon)
+                    write_hgt_zip(join(self.www_dir, "srtm", "Eurasia",
+                        get_hgt_name(lat, lon) + ".zip"), lat, lon)
+
+        if generate:
+            json.dump(params, open(params_file, "wb"))
+
+    def _create_project(self, server_address):
+        """Create the benchmark project, which inherits the configuration of
+        the real project."""
+        if not os.path.isdir(self.project_dir):
+            os.makedirs(self.project_dir)
+        # Tools built in the real project.
+        build_link = join(self.project_dir, "build")
+        real_build_dir = join(self.real_project_dir, "build")
+        if not os.path.islink(build_link) and os.path.isdir(real_build_dir):
+            os.symlink(real_build_dir, build_link)
+
+        lines = ["# Generated by benchmark.py"]
+        for name in ("config.py", "config_local.py"):
+            path = join(self.real_project_dir, name)
+            if os.path.isfile(path):
+                lines.append("execfile({0!r})".format(path))
+        lines.extend([
+            "locals().pop('EXTENT_OSM', None)",
+            "EXTENT = {0!r}".format(self.extent),
+            "OSM_DATA_URLS = {0!r}".format(self.osm_urls),
+            "SRTM_SERVER = {0!r}".format(server_address),
+            "SRTM_DIRECTORY = '/srtm/'",
+            "SRTM_HGT_URLS = []",
+            "USE_HILLSHADING = False",
+        ])
+        # Settings to compare, such as OSM2PGSQL_SLIM_MODE=True
+        for setting in self.options.settings:
+            key, value = setting.split("=", 1)
+            lines.append("{0} = {1}".format(key.strip(), value.strip()))
+        open(join(self.project_dir, "config.py"), "wb").write(
+            "\n".join(lines) + "\n")
+
+    def setup(self):
+        server = LocalHTTPServer(self.www_dir)
+        server.start()
+        self._generate_data("http://{0}/".format(server.address))
+        self._create_project(server.address)
+
+        executor_options = optparse.Values({
+            "overwrite": False,
+            "verbose": self.options.verbose,
+            "jobs": 1,
+            "force": False,
+        })
+        self.executor = main.BundleExecutor(
+            executor_options, project_dir=self.project_dir)
+        self.executor.bundles = [
+            main.SetupDatabase(self.executor),
+            main.Osm2pgsqlBuild(self.executor),
+            main.OsmconvertBuild(self.executor),
+        ]
+        self.executor.report = main.RunReport("benchmark")
+
+    def _missing_tools(self, tools):
+        return [t for t in tools if not (os.path.isfile(t) or
+            find_executable(t))]
+
+    def _forget_steps(self, bundle):
+        self.executor.metadata.execute(
+            "DELETE FROM steps WHERE bundle = ?", bundle.name)
+
+    def stage_download(self):
+        fetcher = self.executor.fetcher
+        urls = self.osm_urls + self.archive_urls
+        for url in urls:
+            fetcher.clean((url,))
+        maybe_unlink(fetcher.temp_dir)
+        os.makedirs(fetcher.temp_dir)
+
+        start = time.time()
+        fetcher.fetch_all([(url,) for url in urls])
+        size = sum(os.path.getsize(fetcher.get_downloaded_path((url,))) for
+            url in urls)
+        return time.time() - start, size, "bytes"
+
+    def stage_extract(self):
+        fetcher = self.executor.fetcher
+        self.executor.metadata.execute("DELETE FROM extracted")
+        self.executor.metadata.execute("DELETE FROM materialized")
+        maybe_unlink(fetcher.extracted_dir)
+        os.makedirs(fetcher.extracted_dir)
+        maybe_unlink(join(self.project_dir, "data", "bench_extracted"))
+
+        start = time.time()
+        fetcher.fetch_all([(url, join("data", "bench_extracted", str(i))) for
+            (i, url) in enumerate(self.archive_urls)])
+        size = sum(os.path.getsize(fetcher.get_downloaded_path((url,))) for
+            url in self.archive_urls)
+        return time.time() - start, size, "bytes"
+
+    def stage_srtm_download(self):
+        srtm_dir = join(self.project_dir, "data", "srtm")
+        maybe_unlink(srtm_dir)
+        bundle = main.SRTMData(self.executor)
+
+        start = time.time()
+        bundle.download()
+        return time.time() - start, len(self.srtm_tiles), "tiles"
+
+    def stage_import(self):
+        tools = ["psql",
+            join(self.project_dir, "build", "osm2pgsql", "osm2pgsql")]
+        if self.executor.config.OSM_DATA_CLIP:
+            tools.append(self.executor.get_bundle("osmconvertbuild").osmconvert)
+        missing = self._missing_tools(tools)
+        if missing:
+            return "missing: " + ", ".join(missing)
+        bundle = main.OsmData(self.executor, BENCH_OSM_PREFIX)
+        self.executor.bundles.append(bundle)
+        self._forget_steps(bundle)
+        try:
+            bundle.load_data_clean()
+        except subprocess.CalledProcessError:
+            pass
+
+        start = time.time()
+        bundle.load_data()
+        elapsed = time.time() - start
+        if not self.options.keep:
+            bundle.load_data_clean()
+        return elapsed, self.nodes, "nodes"
+
+    def stage_contours(self):
+        missing = self._missing_tools(["psql", "gdalbuildvrt", "gdal_translate",
+            "gdal_contour", "ogr2ogr", "shp2pgsql"])
+        if missing:
+            return "missing: " + ", ".join(missing)
+        bundle = BenchSRTMData(self.executor)
+        self.executor.bundles.append(bundle)
+        self._forget_steps(bundle)
+        for clean in (bundle._clean_mosaic, bundle._drop_generalized_contours,
+            bundle._drop_contours_table):
+            try:
+                clean()
+            except subprocess.CalledProcessError:
+                pass
+
+        start = time.time()
+        bundle.load_data()
+        elapsed = time.time() - start
+        if not self.options.keep:
+            bundle.load_data_clean()
+        return elapsed, len(self.srtm_tiles), "tiles"
+
+    def stage_seed(self):
+        real_config = join(self.real_project_dir, "tilecache", "tilecache.cfg")
+        if not os.path.isfile(real_config):
+            return "missing: " + real_config
+        bundle = main.TileCache(self.executor)
+        missing = self._missing_tools([join(bundle.tc_dir, "tilecache_seed.py")])
+        if missing:
+            return "missing: " + ", ".join(missing)
+
+        # Render the layers of the real project into a separate cache.
+        if not os.path.isdir(bundle.cache_dir):
+            os.makedirs(bundle.cache_dir)
+        bundle.generate_clean()
+        bundle.tc_config = join(self.work_dir, "tilecache.cfg")
+        lines = open(real_config).read().splitlines()
+        for i, line in enumerate(lines):
+            if line.startswith("base="):
+                lines[i] = "base=" + bundle.cache_dir
+        open(bundle.tc_config, "wb").write("\n".join(lines) + "\n")
+
+        start = time.time()
+        bundle.generate()
+        elapsed = time.time() - start
+        tiles = sum(len(files) for (path, dirs, files) in
+            os.walk(bundle.cache_dir))
+        return elapsed, tiles, "tiles"
+
+    def run(self, stages):
+        results = []
+        for stage in stages:
+            log.info("Running stage %s", stage)
+            outcome = getattr(self, "stage_" + stage)()
+            if isinstance(outcome, basestring):
+                log.warn("Skipping stage %s (%s)", stage, outcome)
+                results.append({"stage": stage, "skipped": outcome})
+                continue
+            elapsed, count, unit = outcome
+            results.append({
+                "stage": stage,
+                "wall_time": elapsed,
+                "count": count,
+                "unit": unit,
+                "throughput": count / max(elapsed, 0.001),
+            })
+        return results
+
+
+class BenchSRTMData(main.SRTMData):
+    CONTOURS_TABLE = "bench_contours"
+
+
+def write_results(path, options, results):
+    with open(path, "wb") as f:
+        json.dump({
+            "date": datetime.datetime.now().isoformat(),
+            "extent": options.extent,
+            "nodes": options.nodes,
+            "osm_files": options.osm_files,
+            "features": options.features,
+            "settings": options.settings,
+            "results": results,
+        }, f, indent=2)
+
+def log_results(results):
+    lines = ["%-15s %10s %14s %s" % ("stage", "wall (s)", "throughput", "")]
+    for r in results:
+        if "skipped" in r:
+            lines.append("%-15s skipped (%s)" % (r["stage"], r["skipped"]))
+            continue
+        lines.append("%-15s %10.2f %14.1f %s/s" % (
+            r["stage"], r["wall_time"], r["throughput"], r["unit"]))
+    log.info("Results:\n%s", "\n".join(lines))
+
+
+if __name__ == "__main__":
+
+    usage = "usage: %prog [options] [stage...]"
+
+    parser = optparse.OptionParser(
+        usage=usage, description="Stages: {0} (default: {1}). Stages "
+        "needed by the requested ones are run too.".format(
+        ", ".join(STAGES), ", ".join(DEFAULT_STAGES)))
+
+    parser.add_option("--work-dir",
+         help="Directory for the synthetic data, the benchmark project and "
+         "the results (default: data/benchmark in the project).")
+    parser.add_option("--extent", default="6.0,46.0,6.3,46.3",
+         help="Extent of the synthetic data: minlon,minlat,maxlon,maxlat "
+         "(default: %default).")
+    parser.add_option("--nodes", type="int", default=250000,
+         help="Number of OSM nodes (default: %default).")
+    parser.add_option("--osm-files", type="int", default=2,
+         help="Number of .osm files the nodes are split into "
+         "(default: %default).")
+    parser.add_option("--features", type="int", default=10000,
+         help="Number of shapefile features (default: %default).")
+    parser.add_option("--set", dest="settings", action="append", default=[],
+         metavar="KEY=VALUE",
+         help="Configuration value for the benchmark project, such as "
+         "OSM2PGSQL_SLIM_MODE=True. Can be repeated.")
+    parser.add_option("--keep", action="store_true", default=False,
+         help="Keep the tables created by the import and contours stages.")
+    parser.add_option("-v", "--verbose", action="store_true",
+         default=False, help="Print debug logging")
+
+    (options, args) = parser.parse_args()
+
+    stages = args or DEFAULT_STAGES
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        parser.error("Unknown stages: {0}".format(", ".join(unknown)))
+    for stage in list(stages):
+        stages.extend(PREREQUISITES.get(stage, []))
+    stages = [s for s in STAGES if s in stages]
+
+    logging.basicConfig(level=(logging.DEBUG if options.verbose else
+                               logging.INFO))
+
+    real_project_dir = os.path.normpath(
+        join(os.path.abspath(os.path.dirname(__file__)), os.pardir))
+    work_dir = os.path.abspath(options.work_dir or
+        join(real_project_dir, "data", "benchmark"))
+
+    benchmark = Benchmark(options, work_dir, real_project_dir)
+    benchmark.setup()
+    results = benchmark.run(stages)
+
+    log_results(results)
+    results_path = join(work_dir, "results-{0}.json".format(
+        time.strftime("%Y%m%d-%H%M%S")))
+    write_results(results_path, options, results)
+    log.info("Results written to %s", results_path)
@@ -10,17 +10,55 @@ EXTENT = (5.94, 45.70, 10.54, 47.90)
 SRID_OSM = 900913
 
 USE_OSMOSIS = False
+# Seconds to wait before checking for new changes when replication is up to
+# date (see the replicate command).
+REPLICATION_INTERVAL = 60
+
+# Maximum number of files downloaded at the same time.
+DOWNLOAD_JOBS = 4
+# Maximum number of archives extracted at the same time. None means one per
+# CPU core.
+EXTRACT_JOBS = None
 
 OSM2PGSQL_SVN_URL = "http://svn.openstreetmap.org/applications/utils/export/osm2pgsql/"
 OSM2PGSQL_SVN_REVISION = "27425" # 2012-01-06 13:18:04 +0100 (Fri, 06 Jan 2012)
 # Set this to True if you are loading large data, or if you plan to load diffs.
 OSM2PGSQL_SLIM_MODE = False
-OSM_DATA_URLS = ["http://download.geofabrik.de/osm/europe/switzerland.osm.bz2"]
+# Node cache of osm2pgsql (-C), in MB. None uses three quarters of the available
+# memory, shared by the imports running at the same time.
+OSM2PGSQL_CACHE = None
+# Number of osm2pgsql processes in slim mode (--number-processes). None means
+# one per CPU core, shared by the imports running at the same time.
+OSM2PGSQL_PROCESSES = None
+# Settings of the database user while the OSM data is imported, reset
+# afterwards.
+OSM_IMPORT_DB_SETTINGS = {
+    "synchronous_commit": "off",
+}
+# maintenance_work_mem (used to create the indexes) while the OSM data is
+# imported, in MB. None shares half of the available memory between the
+# indexes created at the same time.
+OSM_IMPORT_MAINTENANCE_WORK_MEM = None
+# Items can be an url, or a list of urls of the same data in several formats
+# (the .pbf one is used).
+OSM_DATA_URLS = [(
+    "http://download.geofabrik.de/osm/europe/switzerland.osm.pbf",
+    "http://download.geofabrik.de/osm/europe/switzerland.osm.bz2",
+)]
+# Clip the downloaded files to EXTENT with osmconvert before importing them. The
+# clipped files are kept in the download cache.
+OSM_DATA_CLIP = True
 # This can be used to use another style file than the upstream default.style.
 # Key should be osm_mapserver or osm_mapnik, value is the path to the style file.
 OSM_DATA_STYLE_PATH = {}
+# Import the tables of all the layers (osm_mapnik and osm_mapserver) at the same
+# time, reading the input files once.
+OSM_DATA_SHARED_IMPORT = True
 
 USE_SRTM = True
+# Server and directory from which the NASA tiles are downloaded.
+SRTM_SERVER = "dds.cr.usgs.gov"
+SRTM_DIRECTORY = "/srtm/version2_1/SRTM3/"
 # List of hgt.zip URLs that should be downloaded instead of the NASA ones.
 # The list should contain tuples (url, target_filename), where target_filename
 # should follow the NASA naming convention: {N,S}NNN{E,W}NNN.hgt.zip file
@@ -33,6 +71,20 @@ SRTM_HGT_URLS = [
 # of 1201 x 1201. This parameter can be useful if you are using tiles that
 # have a higher resolution and should be simplified.
 SRTM_RESIZE_DIMENSION = -1
+# Number of processes used to process the SRTM tiles. None means one per CPU
+# core.
+SRTM_JOBS = None
+# Contour tables generalized from the contours table (lines every 10 meters),
+# for lower zoom levels: (interval in meters, simplification tolerance in
+# meters, first zoom level, last zoom level). Intervals must be multiples of
+# 10. The table of an interval is named contours_INTERVAL. Layers showing them
+# at their zoom levels are generated in contours/ for Mapnik and Mapserver
+# styles to include.
+CONTOURS_GENERALIZED = [
+    (50, 20, 12, 12),
+    (100, 40, 10, 11),
+    (500, 150, 8, 9),
+]
 # Whether to generate a hill shading .tif image from the elevation files.
 # (See http://wiki.openstreetmap.org/wiki/Hillshading_with_Mapnik)
 # This requires USE_SRTM to be True
@@ -65,6 +117,18 @@ SEED_ZOOM_TO = 10
 #   "mapnik_mylayer" : ((11, 12), (13, 13), (15, 16)),
 # }
 SEED_ZOOMS = {}
+# Number of tilecache_seed.py processes running at the same time. None means
+# one per CPU core.
+SEED_JOBS = None
+# Width and height, in metatiles, of the areas seeded by one process.
+SEED_UNIT_METATILES = 4
+# Zoom levels of the tiles deleted when loading replication diffs, which are
+# rendered again when requested.
+EXPIRE_ZOOM_FROM = 1
+EXPIRE_ZOOM_TO = 18
+# Deleted tiles up to this zoom level are seeded again right away (0 to
+# disable).
+EXPIRE_RESEED_ZOOM_TO = 0
 
 USE_APACHE = True
 APACHE_SERVER_NAME = "carto"
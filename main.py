@@ -2,10 +2,17 @@
 
 __author__ = "Sylvain Pasche <sylvain.pasche@gmail.com>"
 
+import ConfigParser
+import contextlib
 import datetime
+from distutils.spawn import find_executable
+import errno
+import fcntl
+import functools
 import glob
 import grp
 import hashlib
+import json
 import logging
 import math
 import multiprocessing
@@ -13,12 +20,25 @@ import optparse
 import os
 from os.path import join
 import pwd
+import Queue
 import re
-import shelve
+import resource
 import shutil
+import sqlite3
 import stat
 import subprocess
 import sys
+import threading
+import time
+import urllib2
+import uuid
+import xml.etree.ElementTree
+
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
 
 thisdir = os.path.abspath(os.path.dirname(__file__))
 sys.path.append(join(thisdir, "third_party"))
@@ -70,10 +90,43 @@ def make_dirs_as_project_owner(project_dir, path):
         if restore_uid:
             os.seteuid(0)
 
+# When set, output of commands run by call() in the current thread is written
+# to call_output.file instead of the console.
+call_output = threading.local()
+# When set, resource usage of commands run by call() in the current thread is
+# added to report_context.record (see RunReport).
+report_context = threading.local()
+
 def call(cmd, *args, **kwargs):
     """subprocess.check_call wrapper to log the command to be run"""
     log.debug("Running command: %r", cmd)
-    subprocess.check_call(cmd, *args, **kwargs)
+    output = getattr(call_output, "file", None)
+    if output and not args:
+        output.flush()
+        kwargs.setdefault("stdout", output)
+        kwargs.setdefault("stderr", subprocess.STDOUT)
+
+    start = time.time()
+    p = subprocess.Popen(cmd, *args, **kwargs)
+    # Using wait4 instead of wait to get the resource usage of the command.
+    while True:
+        try:
+            pid, status, rusage = os.wait4(p.pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+
+    record = getattr(report_context, "record", None)
+    if record is not None:
+        RunReport.add_command(record, cmd, time.time() - start, rusage,
+            p.returncode)
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
 
 def apply_patches(patches_dir, target_dir):
     patches = sorted(p for p in os.listdir(patches_dir) if
@@ -90,120 +143,895 @@ def maybe_unlink(path):
     except OSError:
         pass
 
+def get_available_memory():
+    """Returns the memory which can be used without swapping, in MB."""
+    info = {}
+    for line in open("/proc/meminfo"):
+        key, value = line.split(":", 1)
+        info[key] = int(value.split()[0])
+    if "MemAvailable" in info:
+        available = info["MemAvailable"]
+    else:
+        # Kernels older than 3.14.
+        available = info["MemFree"] + info.get("Buffers", 0) + info.get(
+            "Cached", 0)
+    return available / 1024
+
+def link_file(source, target):
+    """Hard link source to target, or copy it (using a reflink if the
+    filesystem supports it) when a hard link can't be created."""
+    try:
+        os.link(source, target)
+    except OSError, e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        call(["cp", "--reflink=auto", "-p", source, target])
 
+def link_tree(source_dir, target_dir):
+    """Mirror the files of source_dir into target_dir using hard links.
 
-class Fetcher(object):
-    def __init__(self, executor):
-        self.executor = executor
-        self.cache_dir = join(executor.project_dir, "data", "download_cache")
-        if not os.path.isdir(self.cache_dir):
-            make_dirs_as_project_owner(executor.project_dir, self.cache_dir)
-        shelve_file = join(self.cache_dir, "meta.shelve")
-        self.metadata_shelve = shelve.open(shelve_file)
-        if os.getuid() == 0:
-            os.chown(
-                join(self.cache_dir, "meta.shelve"),
-                os.stat(executor.project_dir).st_uid,
-                os.stat(executor.project_dir).st_gid)
+    Existing files in target_dir are replaced.
+    """
+    for path, dirlist, filelist in os.walk(source_dir):
+        target_path = os.path.normpath(
+            join(target_dir, os.path.relpath(path, source_dir)))
+        try:
+            os.makedirs(target_path)
+        except OSError:
+            if not os.path.isdir(target_path):
+                raise
+        for name in dirlist + filelist:
+            source = join(path, name)
+            target = join(target_path, name)
+            if os.path.islink(source):
+                maybe_unlink(target)
+                os.symlink(os.readlink(source), target)
+            elif os.path.isfile(source):
+                if os.path.isfile(target) and os.path.samefile(source, target):
+                    continue
+                maybe_unlink(target)
+                link_file(source, target)
 
-        self.temp_dir = join(self.cache_dir, "temp")
+class FileLock(object):
+    """Exclusive lock on a file, shared between threads and processes.
 
-    def _download(self, url, target_path, md5):
-        filename = os.path.basename(target_path)
+    Usage: with FileLock(path): ...
+    or lock.acquire() and lock.release().
 
-        if (md5 and
-            self.metadata_shelve.get("downloaded_" + url) and
-            self.metadata_shelve.get("md5_" + url) != md5):
-            log.info("md5 changed, removing file")
-            del metadata_shelve["md5_" + url]
-            del metadata_shelve["extracted_" + url]
-            os.unlink(target_path)
+    When not blocking, IOError (EWOULDBLOCK) is raised if the lock is held.
+    """
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self.file = None
 
-        if os.path.isfile(target_path):
+    def acquire(self):
+        self.file = open(self.path, "a")
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX if self.blocking else
+                fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self.file.close()
+            self.file = None
+            raise
+
+    def release(self):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class RunReport(object):
+    """Collects the time and resources used by the bundle commands and by
+    the commands they run with call().
+
+    Bytes read and written are derived from the block I/O counters of the
+    commands, so they don't include data served from the page cache.
+    """
+    # Unit of ru_inblock and ru_oublock on Linux.
+    BLOCK_SIZE = 512
+
+    def __init__(self, command):
+        self.command = command
+        self.started_at = time.time()
+        self.records = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def add_command(record, cmd, elapsed, rusage, returncode):
+        if not isinstance(cmd, basestring):
+            cmd = " ".join(cmd)
+        with record["lock"]:
+            record["commands"].append({
+                "command": cmd,
+                "wall_time": elapsed,
+                "user_time": rusage.ru_utime,
+                "system_time": rusage.ru_stime,
+                "max_rss_kb": rusage.ru_maxrss,
+                "read_bytes": rusage.ru_inblock * RunReport.BLOCK_SIZE,
+                "written_bytes": rusage.ru_oublock * RunReport.BLOCK_SIZE,
+                "returncode": returncode,
+            })
+
+    @contextlib.contextmanager
+    def measure(self, bundle, command):
+        """Record the resources used by a bundle command run inside the
+        with block."""
+        record = {
+            "bundle": bundle.name,
+            "command": command,
+            "commands": [],
+            "lock": threading.Lock(),
+        }
+        start = time.time()
+        start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        report_context.record = record
+        try:
+            yield
+            record["status"] = "ok"
+        except:
+            record["status"] = "failed"
+            raise
+        finally:
+            report_context.record = None
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            record["wall_time"] = time.time() - start
+            # The usage of this process is shared between the bundles running
+            # in parallel.
+            record["process_cpu_time"] = (
+                usage.ru_utime - start_usage.ru_utime +
+                usage.ru_stime - start_usage.ru_stime)
+            del record["lock"]
+            commands = record["commands"]
+            record["cpu_time"] = record["process_cpu_time"] + sum(
+                c["user_time"] + c["system_time"] for c in commands)
+            record["max_rss_kb"] = max(
+                [usage.ru_maxrss] + [c["max_rss_kb"] for c in commands])
+            for key in ("read_bytes", "written_bytes"):
+                record[key] = sum(c[key] for c in commands)
+            with self.lock:
+                self.records.append(record)
+
+    def write(self, path):
+        with open(path, "wb") as f:
+            json.dump({
+                "command": self.command,
+                "started_at": self.started_at,
+                "wall_time": time.time() - self.started_at,
+                "cpu_count": multiprocessing.cpu_count(),
+                "bundles": self.records,
+            }, f, indent=2)
+
+    def log_summary(self):
+        if not self.records:
             return
+        MB = 1024.0 * 1024
+        lines = ["%-28s %10s %10s %10s %10s %10s %s" % ("bundle", "wall (s)",
+            "cpu (s)", "rss (MB)", "read (MB)", "write (MB)", "status")]
+        for r in self.records:
+            lines.append("%-28s %10.1f %10.1f %10.1f %10.1f %10.1f %s" % (
+                r["bundle"], r["wall_time"], r["cpu_time"],
+                r["max_rss_kb"] / 1024.0, r["read_bytes"] / MB,
+                r["written_bytes"] / MB, r["status"]))
+        lines.append("Total wall time: %.1f s" % (time.time() - self.started_at))
+        log.info("Resource usage of %s:\n%s", self.command, "\n".join(lines))
+
+class ThreadLogFilter(logging.Filter):
+    """Only accepts records logged by a thread or the threads it started."""
+    def __init__(self, thread_name):
+        logging.Filter.__init__(self)
+        self.thread_name = thread_name
+
+    def filter(self, record):
+        return (record.threadName == self.thread_name or
+            record.threadName.startswith(self.thread_name + ":"))
+
+class MetadataStore(object):
+    """SQLite database recording the state of the project.
+
+    The database uses write ahead logging and every statement is committed
+    on its own, so that several threads and processes can update it
+    concurrently and that no state is lost if a process is interrupted.
+    Each thread gets its own connection.
+    """
+    def __init__(self, project_dir, path):
+        self.path = path
+        self.local = threading.local()
+        self._get_connection()
+        if os.getuid() == 0:
+            for p in (path, path + "-wal", path + "-shm"):
+                if os.path.exists(p):
+                    os.chown(p,
+                        os.stat(project_dir).st_uid,
+                        os.stat(project_dir).st_gid)
+
+    def _get_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.path, timeout=60, isolation_level=None)
+            connection.text_factory = str
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def create_tables(self, statements):
+        for sql in statements:
+            self.execute(sql)
+
+    def execute(self, sql, *params):
+        self._get_connection().execute(sql, params)
+
+    def query(self, sql, *params):
+        return self._get_connection().execute(sql, params).fetchall()
+
+    def query_row(self, sql, *params):
+        rows = self.query(sql, *params)
+        return rows[0] if rows else None
+
+    def query_value(self, sql, *params):
+        row = self.query_row(sql, *params)
+        return row[0] if row else None
+
+class WorkerPool(object):
+    """Runs tasks on a bounded number of threads.
+
+    The first exception raised by a task is re-raised by join(). Once a task
+    failed, the tasks which didn't start yet are skipped.
+    """
+    def __init__(self, jobs, name="worker"):
+        self.queue = Queue.Queue()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.error = None
+        self.threads = []
+        # Worker threads are named after the creating thread, and inherit
+        # its command output, so that their logs end up in the same place.
+        parent_name = threading.current_thread().name
+        self.output = getattr(call_output, "file", None)
+        self.step_stack = list(getattr(step_context, "stack", []))
+        self.record = getattr(report_context, "record", None)
+        for i in range(max(1, jobs)):
+            t = threading.Thread(target=self._run,
+                name="%s:%s-%d" % (parent_name, name, i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        call_output.file = self.output
+        # The config read by the worker is recorded in its own frame, and
+        # added to the steps of the creating thread when the worker stops.
+        reads = set()
+        step_context.stack = [reads] if self.step_stack else []
+        report_context.record = self.record
+        while True:
+            task = self.queue.get()
+            if task is None:
+                with self.condition:
+                    for frame in self.step_stack:
+                        frame.update(reads)
+                return
+            func, args = task
+            try:
+                if self.error is None:
+                    func(*args)
+            except Exception:
+                with self.condition:
+                    if self.error is None:
+                        self.error = sys.exc_info()
+            with self.condition:
+                self.pending -= 1
+                self.condition.notify_all()
+
+    def submit(self, func, *args):
+        with self.condition:
+            self.pending += 1
+        self.queue.put((func, args))
+
+    def join(self):
+        # Waiting with a timeout keeps the main thread interruptible.
+        with self.condition:
+            while self.pending:
+                self.condition.wait(0.5)
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+
+
+# Steps running in the current thread (see cached_step).
+step_context = threading.local()
+
+class Config(object):
+    """Configuration values, as attributes.
+
+    Values read while cached steps are running are recorded as inputs of
+    these steps.
+    """
+    def __init__(self, d):
+        self.__dict__.update(d)
+
+    def __getattribute__(self, name):
+        if not name.startswith("__"):
+            for reads in getattr(step_context, "stack", ()):
+                reads.add(name)
+        return object.__getattribute__(self, name)
+
+def cached_step(config=(), files=None, upstream=(), clean=None):
+    """Decorator for bundle methods that only need to run again when their
+    inputs changed since their last successful run.
+
+    The inputs are:
+    * The configuration values read while the method runs, and the ones
+      listed in config (for values read elsewhere, such as in __init__).
+    * The size and modification time of the paths returned by the bundle
+      method named files.
+    * The last run of the upstream steps, named "bundle_name.method_name".
+
+    When the inputs changed, the bundle method named clean is called before
+    running the method again.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            return self.executor.steps.run(self, func, args, kwargs,
+                config, files, upstream, clean)
+        wrapper.step_args = (config, files, upstream, clean)
+        return wrapper
+    return decorator
+
+class StepCache(object):
+    """Records the inputs of the cached steps (see cached_step)."""
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS steps (
+            name TEXT PRIMARY KEY,
+            bundle TEXT NOT NULL,
+            command TEXT,
+            inputs TEXT NOT NULL,
+            token TEXT NOT NULL,
+            finished_at REAL NOT NULL)""",
+    ]
+    # Config values which aren't inputs: the ones only changing how fast
+    # or with which credentials the steps run, not their results.
+    IGNORED_CONFIG = ("executor", "DB_PASSWORD", "DOWNLOAD_JOBS",
+        "EXTRACT_JOBS", "OSM2PGSQL_CACHE", "OSM2PGSQL_PROCESSES",
+        "OSM_IMPORT_DB_SETTINGS", "OSM_IMPORT_MAINTENANCE_WORK_MEM",
+        "OSM_DATA_SHARED_IMPORT", "SRTM_JOBS", "SEED_JOBS",
+        "REPLICATION_INTERVAL")
 
+    def __init__(self, executor):
+        self.executor = executor
+        self.metadata = executor.metadata
+        self.metadata.create_tables(self.SCHEMA)
+        # Steps which ran (or were recorded) by this process, which --force
+        # doesn't run again.
+        self.done = set()
+
+    def _get_inputs(self, config_names, paths, upstream):
+        config = self.executor.config.__dict__
+        inputs = {"config": {}, "files": {}, "upstream": {}}
+        for name in config_names:
+            if name in self.IGNORED_CONFIG:
+                continue
+            inputs["config"][name] = json.dumps(
+                config.get(name), sort_keys=True, default=repr)
+        for path in paths:
+            try:
+                st = os.stat(path)
+                inputs["files"][path] = [st.st_size, st.st_mtime]
+            except OSError:
+                inputs["files"][path] = None
+        for name in upstream:
+            inputs["upstream"][name] = self.metadata.query_value(
+                "SELECT token FROM steps WHERE name = ?", name)
+        # Normalize the values (tuples, ...) like when loaded from the store.
+        return json.loads(json.dumps(inputs, sort_keys=True))
+
+    def _describe_changes(self, previous, current):
+        changes = []
+        for kind in sorted(current):
+            for key in sorted(set(previous.get(kind, {})) | set(current[kind])):
+                if previous.get(kind, {}).get(key) != current[kind].get(key):
+                    changes.append(key)
+        return changes
+
+    def _get_previous_inputs(self, name, paths, upstream):
+        """Returns the inputs of the last run of a step (None if it never
+        ran) and its current inputs."""
+        row = self.metadata.query_row(
+            "SELECT inputs FROM steps WHERE name = ?", name)
+        if not row:
+            return None, None
+        previous = json.loads(row[0])
+        # Values recorded before they were ignored.
+        for name in self.IGNORED_CONFIG:
+            previous["config"].pop(name, None)
+        current = self._get_inputs(previous["config"], paths, upstream)
+        # Upstream steps which had never been recorded when this step
+        # ran are assumed to be the ones that are recorded now.
+        for key, value in previous["upstream"].items():
+            if value is None:
+                previous["upstream"][key] = current["upstream"].get(key)
+        return previous, current
+
+    def _is_forced(self, name):
+        return self.executor.options.force and name not in self.done
+
+    def is_current(self, bundle, method_name):
+        """Returns whether the cached step of the bundle is up to date."""
+        config, files, upstream, clean = getattr(
+            bundle.__class__, method_name).step_args
+        name = "{0}.{1}".format(bundle.name, method_name)
+        paths = getattr(bundle, files)() if files else []
+        previous, current = self._get_previous_inputs(name, paths, upstream)
+        return (previous is not None and not self._is_forced(name) and
+            current == previous)
+
+    def record(self, bundle, method_name, reads=()):
+        """Records the cached step of the bundle as run, for steps whose work
+        was done by another step. reads are the config values read."""
+        config, files, upstream, clean = getattr(
+            bundle.__class__, method_name).step_args
+        self._record("{0}.{1}".format(bundle.name, method_name), bundle,
+            set(config) | set(reads),
+            getattr(bundle, files)() if files else [], upstream)
+
+    def _record(self, name, bundle, reads, paths, upstream):
+        self.metadata.execute(
+            "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, ?, ?)",
+            name, bundle.name, getattr(step_context, "command", None),
+            json.dumps(self._get_inputs(reads, paths, upstream)),
+            uuid.uuid4().hex, time.time())
+        self.done.add(name)
+
+    def run(self, bundle, func, args, kwargs, config, files, upstream, clean):
+        name = "{0}.{1}".format(bundle.name, func.__name__)
+        paths = getattr(bundle, files)() if files else []
+
+        previous, current = self._get_previous_inputs(name, paths, upstream)
+        if previous is not None:
+            if self._is_forced(name):
+                log.info("Running step %s again (forced)", name)
+            elif current == previous:
+                log.info("Step %s is up to date", name)
+                self.metadata.execute(
+                    "UPDATE steps SET inputs = ? WHERE name = ?",
+                    json.dumps(current), name)
+                return
+            else:
+                log.info("Inputs of step %s changed (%s), running it again",
+                    name, ", ".join(self._describe_changes(previous, current)))
+            if clean:
+                getattr(bundle, clean)()
+
+        reads = set(config)
+        if not hasattr(step_context, "stack"):
+            step_context.stack = []
+        step_context.stack.append(reads)
         try:
-            shutil.rmtree(self.temp_dir, True)
-            os.makedirs(self.temp_dir)
-            call(["wget", url], cwd=self.temp_dir)
-
-            downloaded_file = join(self.temp_dir, filename)
-            actual_md5 = None
-            if md5:
-                m = hashlib.md5()
-                m.update(open(downloaded_file, "rb").read())
-                actual_md5 = m.hexdigest()
-                if actual_md5 != md5:
-                    raise Exception(
-                        "Downloaded file {0} doesn't match md5sum "
-                        "(expected: {1} actual: {2})".
-                        format(url, md5, actual_md5))
-
-            os.rename(downloaded_file, target_path)
-            self.metadata_shelve["downloaded_" + url] = True
-            if actual_md5:
-                self.metadata_shelve["md5_" + url] = actual_md5
+            result = func(bundle, *args, **kwargs)
         finally:
-            shutil.rmtree(self.temp_dir, True)
+            step_context.stack.pop()
 
-    def _extract(self, url, target_path, extract_dir):
-        if "extracted_" + url in self.metadata_shelve:
-            log.debug("File marked as already extracted")
-            return
-        log.info("Extracting %s to %s", target_path, extract_dir)
-        if target_path.endswith(".tgz") or target_path.endswith(".tar.gz"):
-            tool = "tar"
-            tar_opt = "z"
-        elif target_path.endswith(".bz2"):
-            tool = "tar"
-            tar_opt = "j"
-        elif target_path.endswith(".zip"):
-            tool = "zip"
-        else:
-            raise Exception(
-                "Doesn't know how to extract {0} archive".format(target_path))
+        self._record(name, bundle, reads, paths, upstream)
+        return result
 
-        absolute_extract_dir = join(self.executor.project_dir, extract_dir)
-        if not os.path.isdir(absolute_extract_dir):
-            os.makedirs(absolute_extract_dir)
+    def forget(self, bundle_name, command):
+        """Make the steps run by command on the bundle run again."""
+        self.metadata.execute(
+            "DELETE FROM steps WHERE bundle = ? AND command = ?",
+            bundle_name, command)
 
-        if tool == "tar":
-            call(["tar", tar_opt + "xf", target_path], cwd=absolute_extract_dir)
-        elif tool == "zip":
-            call(["unzip", "-q", "-d", absolute_extract_dir, target_path])
-        else:
-            assert False
-        self.metadata_shelve["extracted_" + url] = True
-        self.metadata_shelve.sync()
 
-    def fetch(self, resource):
-        log.debug("Fetching: %s", resource)
+class Fetcher(object):
+    """Downloads resources into a content addressed store.
+
+    Downloaded files are stored once under objects/ named by their sha1, and
+    extracted once under extracted/. Consumers get hard links to the stored
+    files, so that resources shared by several bundles (even under different
+    urls) don't use disk space or extraction time more than once.
+
+    Files computed from a resource by its consumers (such as a clipped .osm
+    file) are kept under derived/, and deleted with the content.
+    """
+    # Number of times a failed transfer is resumed before giving up.
+    RETRIES = 3
+    CHUNK_SIZE = 256 * 1024
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS resources (
+            url TEXT PRIMARY KEY,
+            sha1 TEXT NOT NULL,
+            md5 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            downloaded_at REAL NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS extracted (
+            sha1 TEXT PRIMARY KEY,
+            extracted_at REAL NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS materialized (
+            url TEXT NOT NULL,
+            target_dir TEXT NOT NULL,
+            subdir TEXT NOT NULL,
+            sha1 TEXT NOT NULL,
+            PRIMARY KEY (url, target_dir, subdir))""",
+    ]
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.cache_dir = join(executor.project_dir, "data", "download_cache")
+        if not os.path.isdir(self.cache_dir):
+            make_dirs_as_project_owner(executor.project_dir, self.cache_dir)
+        self.metadata = executor.metadata
+        self.metadata.create_tables(self.SCHEMA)
+        # Protects the locks dictionary.
+        self.lock = threading.Lock()
+        # Bounds the number of concurrent transfers, whatever the number of
+        # bundles fetching resources at the same time.
+        self.transfer_slots = threading.BoundedSemaphore(
+            max(1, executor.config.DOWNLOAD_JOBS))
+        self.locks = {}
+
+        # Partially downloaded files are kept there between runs so that
+        # transfers can be resumed.
+        self.temp_dir = join(self.cache_dir, "temp")
+        self.objects_dir = join(self.cache_dir, "objects")
+        self.extracted_dir = join(self.cache_dir, "extracted")
+        self.derived_dir = join(self.cache_dir, "derived")
+        self.locks_dir = join(self.cache_dir, "locks")
+        for d in (self.temp_dir, self.objects_dir, self.extracted_dir,
+            self.derived_dir, self.locks_dir):
+            if not os.path.isdir(d):
+                make_dirs_as_project_owner(executor.project_dir, d)
+
+    def _get_hash(self, url):
+        return self.metadata.query_value(
+            "SELECT sha1 FROM resources WHERE url = ?", url)
+
+    def _get_thread_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    @contextlib.contextmanager
+    def _get_lock(self, key):
+        """Lock key against other threads and other processes."""
+        with self._get_thread_lock(key):
+            with FileLock(join(self.locks_dir,
+                hashlib.sha1(key).hexdigest())):
+                yield
+
+    def _get_object_path(self, sha1):
+        return join(self.objects_dir, sha1[:2], sha1)
+
+    def _hash_file(self, path):
+        md5, sha1 = hashlib.md5(), hashlib.sha1()
+        with open(path, "rb") as f:
+            for data in iter(lambda: f.read(self.CHUNK_SIZE), ""):
+                md5.update(data)
+                sha1.update(data)
+        return md5, sha1
+
+    def _transfer(self, url, part_path):
+        """Download url into part_path, resuming from the bytes already there.
+
+        Returns the md5 and sha1 of the complete file, computed while the data
+        is written.
+        """
+        offset = 0
+        if os.path.isfile(part_path):
+            offset = os.path.getsize(part_path)
+
+        request = urllib2.Request(url)
+        if offset:
+            request.add_header("Range", "bytes={0}-".format(offset))
+        try:
+            response = urllib2.urlopen(request, timeout=60)
+        except urllib2.HTTPError, e:
+            if e.code != 416 or not offset:
+                raise
+            log.info("Server refused to resume %s, restarting", url)
+            os.unlink(part_path)
+            return self._transfer(url, part_path)
+
+        if offset and response.getcode() == 206:
+            log.info("Resuming %s at byte %d", url, offset)
+            md5, sha1 = self._hash_file(part_path)
+            mode = "ab"
+            # Content-Range: bytes <first>-<last>/<total>
+            total = response.info().getheader(
+                "Content-Range", "").split("/")[-1]
+        else:
+            md5, sha1 = hashlib.md5(), hashlib.sha1()
+            offset = 0
+            mode = "wb"
+            total = response.info().getheader("Content-Length")
+
+        start = time.time()
+        transferred = 0
+        with open(part_path, mode) as f:
+            for data in iter(lambda: response.read(self.CHUNK_SIZE), ""):
+                md5.update(data)
+                sha1.update(data)
+                f.write(data)
+                transferred += len(data)
+        response.close()
+        # read() returns the data received so far when the connection drops.
+        if total and total.isdigit() and offset + transferred != int(total):
+            raise IOError("Transfer of {0} interrupted after {1} of {2} "
+                "bytes".format(url, offset + transferred, total))
+
+        elapsed = max(time.time() - start, 0.001)
+        log.info("Downloaded %s (%d bytes, %.1f KB/s)",
+            url, offset + transferred, transferred / elapsed / 1024)
+        return md5.hexdigest(), sha1.hexdigest()
+
+    def _store(self, url, path, actual_md5, sha1):
+        """Move a downloaded file into the store and index it under url."""
+        object_path = self._get_object_path(sha1)
+        with self._get_lock(sha1):
+            if os.path.isfile(object_path):
+                log.debug("Content of %s already in the store", url)
+                os.unlink(path)
+            else:
+                if not os.path.isdir(os.path.dirname(object_path)):
+                    os.makedirs(os.path.dirname(object_path))
+                os.rename(path, object_path)
+        self.metadata.execute(
+            "INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?)",
+            url, sha1, actual_md5, os.path.getsize(object_path), time.time())
+
+    def _download(self, url, md5):
+        with self._get_lock(url):
+            self._download_locked(url, md5)
+        self._link_named_file(url)
+
+    def _download_locked(self, url, md5):
+        row = self.metadata.query_row(
+            "SELECT sha1, md5 FROM resources WHERE url = ?", url)
+        sha1 = row and row[0]
+        if sha1 and os.path.isfile(self._get_object_path(sha1)):
+            if not md5 or row[1] == md5:
+                return
+            log.info("md5 changed, downloading %s again", url)
+            self._forget(url)
+            sha1 = None
+
+        # Adopt files downloaded before the store existed.
+        legacy_path = self._get_path(url)
+        if not sha1 and os.path.isfile(legacy_path):
+            actual_md5, actual_sha1 = self._hash_file(legacy_path)
+            if not md5 or actual_md5.hexdigest() == md5:
+                log.debug("Moving %s into the store", legacy_path)
+                part_path = join(self.temp_dir, actual_sha1.hexdigest())
+                os.rename(legacy_path, part_path)
+                self._store(url, part_path, actual_md5.hexdigest(),
+                    actual_sha1.hexdigest())
+                return
+
+        part_path = join(self.temp_dir,
+            hashlib.sha1(url).hexdigest() + ".part")
+        log.info("Downloading %s", url)
+        for attempt in range(self.RETRIES + 1):
+            try:
+                with self.transfer_slots:
+                    actual_md5, sha1 = self._transfer(url, part_path)
+                break
+            except (urllib2.URLError, IOError), e:
+                # Client errors (such as a missing file) aren't transient.
+                if attempt == self.RETRIES or (
+                    isinstance(e, urllib2.HTTPError) and 400 <= e.code < 500):
+                    raise
+                log.warn("Error while downloading %s (%s), retrying", url, e)
+                time.sleep(2 ** attempt)
+
+        if md5 and actual_md5 != md5:
+            # Don't try to resume from corrupted data next time.
+            os.unlink(part_path)
+            raise Exception(
+                "Downloaded file {0} doesn't match md5sum "
+                "(expected: {1} actual: {2})".
+                format(url, md5, actual_md5))
+
+        self._store(url, part_path, actual_md5, sha1)
+
+    def _link_named_file(self, url):
+        """Make the downloaded file available under its original name."""
+        object_path = self._get_object_path(self._get_hash(url))
+        path = self._get_path(url)
+        with self._get_lock(path):
+            if (os.path.isfile(path) and
+                os.path.samefile(path, object_path)):
+                return
+            maybe_unlink(path)
+            link_file(object_path, path)
+
+    def _get_tar_command(self, name, target_path):
+        """Command extracting target_path, an archive named name."""
+        if name.endswith(".tgz") or name.endswith(".tar.gz"):
+            tar_opt, programs = "z", ("pigz",)
+        elif name.endswith(".bz2"):
+            # pbzip2 only decompresses in parallel the files it compressed.
+            tar_opt, programs = "j", ("lbzip2", "pbzip2")
+        else:
+            return None
+        # Prefer multi-threaded decompressors when they are installed.
+        for program in programs:
+            if find_executable(program):
+                return ["tar", "--use-compress-program=" + program, "-xf",
+                    target_path]
+        return ["tar", tar_opt + "xf", target_path]
+
+    def _extract(self, url):
+        """Extract the archive downloaded from url in the store (once per
+        content) and return the directory containing the extracted files."""
+        sha1 = self._get_hash(url)
+        tree = join(self.extracted_dir, sha1)
+        with self._get_lock(sha1):
+            if os.path.isdir(tree) and self.metadata.query_value(
+                "SELECT extracted_at FROM extracted WHERE sha1 = ?", sha1):
+                log.debug("File already extracted")
+                return tree
+
+            # The stored content is read, as other urls may have the same
+            # file name. The name tells the format.
+            name = os.path.basename(self._get_path(url))
+            archive = self._get_object_path(sha1)
+            log.info("Extracting %s", name)
+            temp_tree = tree + ".tmp"
+            maybe_unlink(temp_tree)
+            os.makedirs(temp_tree)
+
+            tar_command = self._get_tar_command(name, archive)
+            if tar_command:
+                call(tar_command, cwd=temp_tree)
+            elif name.endswith(".zip"):
+                call(["unzip", "-q", "-d", temp_tree, archive])
+            else:
+                raise Exception(
+                    "Doesn't know how to extract {0} archive".format(name))
+            maybe_unlink(tree)
+            os.rename(temp_tree, tree)
+            self.metadata.execute(
+                "INSERT OR REPLACE INTO extracted VALUES (?, ?)",
+                sha1, time.time())
+        return tree
+
+    def _materialize(self, url, target_dir, subdir="."):
+        """Hard link the extracted content of url (or its subdir) into
+        target_dir, relative to the project directory."""
+        if self._is_materialized(url, target_dir, subdir):
+            log.debug("%s already in %s", url, target_dir)
+            return
+        # Archives going into the same directory are extracted at the same
+        # time (under extracted/), only linking them is serialized.
+        tree = self._extract(url)
+        with self._get_lock(join(self.executor.project_dir, target_dir)):
+            if self._is_materialized(url, target_dir, subdir):
+                return
+            log.info("Linking content of %s into %s", url, target_dir)
+            link_tree(
+                os.path.normpath(join(tree, subdir)),
+                join(self.executor.project_dir, target_dir))
+            self.metadata.execute(
+                "INSERT OR REPLACE INTO materialized VALUES (?, ?, ?, ?)",
+                url, target_dir, subdir, self._get_hash(url))
+
+    def _is_materialized(self, url, target_dir, subdir):
+        return self.metadata.query_value(
+            "SELECT sha1 FROM materialized "
+            "WHERE url = ? AND target_dir = ? AND subdir = ?",
+            url, target_dir, subdir) == self._get_hash(url)
+
+    def _parse_resource(self, resource):
         resource = list(resource) + [None, None]
 
         url = resource.pop(0)
         extract_dir = resource.pop(0)
         md5 = resource.pop(0)
+        return url, extract_dir, md5
 
-        filename = url.split("/")[-1]
-        target_path = join(self.cache_dir, filename)
+    def fetch(self, resource):
+        self.fetch_all([resource])
+
+    def fetch_all(self, resources):
+        """Download the given resources concurrently and extract them.
+
+        Archives are extracted as soon as their download is finished, while
+        the other downloads are still running.
+        """
+        resources = [self._parse_resource(r) for r in resources]
+
+        extract_pool = WorkerPool(
+            self.executor.config.EXTRACT_JOBS or multiprocessing.cpu_count(),
+            name="extract")
 
-        was_downloaded = self._download(url, target_path, md5)
-        if extract_dir:
-            self._extract(url, target_path, extract_dir)
+        def fetch_one(url, extract_dir, md5):
+            self._download(url, md5)
+            if extract_dir:
+                extract_pool.submit(self._materialize, url, extract_dir)
+
+        download_pool = WorkerPool(len(resources), name="download")
+        for url, extract_dir, md5 in resources:
+            log.debug("Fetching: %s", url)
+            download_pool.submit(fetch_one, url, extract_dir, md5)
+        try:
+            download_pool.join()
+        except:
+            error = sys.exc_info()
+            # Wait for the running extractions, but report the download
+            # error rather than theirs.
+            try:
+                extract_pool.join()
+            except Exception, e:
+                log.error("Error while extracting: %s", e)
+            raise error[0], error[1], error[2]
+        extract_pool.join()
+
+    def link_downloaded(self, resource, target_dir):
+        """Hard link the downloaded file of resource into target_dir."""
+        url, extract_dir, md5 = self._parse_resource(resource)
+        self._download(url, md5)
+        target = join(self.executor.project_dir, target_dir,
+            os.path.basename(self._get_path(url)))
+        source = self.get_downloaded_path(resource)
+        if os.path.isfile(target) and os.path.samefile(target, source):
+            return
+        maybe_unlink(target)
+        link_file(source, target)
+
+    def materialize(self, resource, target_dir, subdir="."):
+        """Hard link the extracted content of resource into target_dir."""
+        url, extract_dir, md5 = self._parse_resource(resource)
+        self._download(url, md5)
+        self._materialize(url, target_dir, subdir)
 
     def clean(self, resource):
-        r = list(resource) + [None, None]
-        url = r.pop(0)
-        extract_dir = r.pop(0)
+        url, extract_dir, md5 = self._parse_resource(resource)
         # TODO: 
         assert not extract_dir, "Cleaning extracted resource not implemented yet"
-        maybe_unlink(self.get_downloaded_path(resource))
-
-    def get_downloaded_path(self, resource):
-        url = resource[0]
+        self._forget(url)
+
+    def _forget(self, url):
+        """Remove the file downloaded from url, and its stored, extracted and
+        derived content unless other urls share it."""
+        sha1 = self._get_hash(url)
+        maybe_unlink(self._get_path(url))
+        self.metadata.execute("DELETE FROM resources WHERE url = ?", url)
+        self.metadata.execute("DELETE FROM materialized WHERE url = ?", url)
+        if not sha1:
+            return
+        # Other urls might share the same content.
+        if not self.metadata.query_value(
+            "SELECT count(*) FROM resources WHERE sha1 = ?", sha1):
+            self.metadata.execute("DELETE FROM extracted WHERE sha1 = ?", sha1)
+            maybe_unlink(self._get_object_path(sha1))
+            maybe_unlink(join(self.extracted_dir, sha1))
+            for path in glob.glob(join(self.derived_dir, sha1 + "-*")):
+                maybe_unlink(path)
+
+    def _get_path(self, url):
         filename = url.split("/")[-1]
         return join(self.cache_dir, filename)
 
+    def get_downloaded_path(self, resource):
+        return self._get_path(resource[0])
+
+    def get_derived_path(self, resource, name):
+        """Returns the path of a file computed from the content of a
+        downloaded resource. name identifies the computation."""
+        return join(self.derived_dir, "{0}-{1}".format(
+            self._get_hash(resource[0]), name))
+
 
 class SVNCheckoutMixin(object):
     def init_svn(self, checkout_dir, url, revision, export=False):
@@ -262,6 +1090,15 @@ class Bundle(object):
     def dependencies(self):
         return []
 
+    @property
+    def run_after(self):
+        """Names of bundles which must have run before this one when they
+        are loaded, without being dependencies.
+
+        This is only used when running bundles in parallel.
+        """
+        return []
+
     # To override
     def create_project(self):
         pass
@@ -283,8 +1120,7 @@ class Bundle(object):
         pass
 
     def fetch_resources(self, resources):
-        for resource in resources:
-            self.executor.fetcher.fetch(resource)
+        self.executor.fetcher.fetch_all(resources)
 
     def clean_resources(self, resources):
         for resource in resources:
@@ -320,7 +1156,7 @@ class CoreBundle(Bundle):
         self._copy_template_directory()
 
     def system_setup(self):
-        self.install_packages("unzip")
+        self.install_packages("unzip lbzip2 pigz")
 
     def _process_dot_in_file(self, content, vars, template_dir):
         if content.startswith("# Tempita"):
@@ -389,6 +1225,42 @@ class CoreBundle(Bundle):
 
 
 class SetupDatabase(Bundle):
+    """Database setup, and queries of the other bundles.
+
+    Queries go through a pool of connections kept open when psycopg2 is
+    installed, and through psql otherwise.
+    """
+    def __init__(self, executor):
+        super(SetupDatabase, self).__init__(executor)
+        # Idle connections, shared by the threads of the bundles.
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _get_cursor(self):
+        with self.connections_lock:
+            conn = self.connections.pop() if self.connections else None
+        if conn is None:
+            conn = psycopg2.connect(host=self.config.DB_HOST,
+                port=self.config.DB_PORT, database=self.config.DB_NAME,
+                user=self.config.DB_USER, password=self.config.DB_PASSWORD)
+            # Like psql, each statement is committed on its own.
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            cursor = conn.cursor()
+            yield cursor
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The connection is lost.
+            conn.close()
+            raise
+        except:
+            with self.connections_lock:
+                self.connections.append(conn)
+            raise
+        with self.connections_lock:
+            self.connections.append(conn)
 
     def _get_psql_env(self):
         env = os.environ.copy()
@@ -400,6 +1272,15 @@ class SetupDatabase(Bundle):
         return env
 
     def query_succeeds(self, sql):
+        if psycopg2:
+            try:
+                with self._get_cursor() as cursor:
+                    cursor.execute(sql)
+            except psycopg2.Error, e:
+                log.debug("Query %r failed: %s", sql, e)
+                return False
+            return True
+
         try:
             call(["psql", "-q", "-o/dev/null", "-c", sql],
                 env=self._get_psql_env())
@@ -409,17 +1290,82 @@ class SetupDatabase(Bundle):
         return True
 
     def execute_sql(self, sql):
+        if psycopg2:
+            log.debug("Executing SQL: %r", sql)
+            with self._get_cursor() as cursor:
+                cursor.execute(sql)
+            return
         call(["psql", "-c", sql], env=self._get_psql_env())
 
-    def execute_sql_file(self, file):
+    def get_existing_tables(self, tables):
+        """Returns the set of the given tables which exist, looked up with a
+        single query."""
+        if not tables:
+            return set()
+        sql = ("SELECT relname FROM pg_class WHERE relkind IN ('r', 'v') "
+            "AND pg_table_is_visible(oid) AND relname IN ({0})".format(
+            ", ".join("'{0}'".format(t) for t in tables)))
+        if psycopg2:
+            with self._get_cursor() as cursor:
+                cursor.execute(sql)
+                return set(row[0] for row in cursor.fetchall())
+
+        psql = subprocess.Popen(["psql", "-A", "-t", "-c", sql],
+            env=self._get_psql_env(), stdout=subprocess.PIPE)
+        output = psql.communicate()[0]
+        if psql.returncode:
+            raise subprocess.CalledProcessError(psql.returncode, "psql")
+        return set(output.split())
+
+    def get_user_settings(self):
+        """Returns the configuration parameters set on the database user
+        (with ALTER ROLE ... SET), by name."""
+        sql = ("SELECT unnest(rolconfig) FROM pg_roles "
+            "WHERE rolname = '{0}'".format(self.config.DB_USER))
+        if psycopg2:
+            with self._get_cursor() as cursor:
+                cursor.execute(sql)
+                rows = [row[0] for row in cursor.fetchall()]
+        else:
+            psql = subprocess.Popen(["psql", "-A", "-t", "-c", sql],
+                env=self._get_psql_env(), stdout=subprocess.PIPE)
+            rows = psql.communicate()[0].splitlines()
+            if psql.returncode:
+                raise subprocess.CalledProcessError(psql.returncode, "psql")
+        return dict(row.split("=", 1) for row in rows if "=" in row)
+
+    def _set_user_setting(self, name, value):
+        self.execute_sql("ALTER ROLE \"{0}\" SET {1} = '{2}'".format(
+            self.config.DB_USER, name, str(value).replace("'", "''")))
+
+    @contextlib.contextmanager
+    def user_settings(self, settings):
+        """Sets configuration parameters of the sessions of the database user
+        started while the block runs. The values the user had before are
+        set back afterwards."""
+        previous = self.get_user_settings()
+        for name, value in sorted(settings.iteritems()):
+            self._set_user_setting(name, value)
+        try:
+            yield
+        finally:
+            for name in sorted(settings):
+                if name in previous:
+                    self._set_user_setting(name, previous[name])
+                else:
+                    self.execute_sql('ALTER ROLE "{0}" RESET {1}'.format(
+                        self.config.DB_USER, name))
+
+    def execute_sql_file(self, file, stop_on_error=False):
+        """Runs the statements of file with psql. With stop_on_error, the
+        first failing statement fails the call instead of being skipped."""
         if isinstance(file, str):
             file = open(file)
-        p = subprocess.Popen(
-            "psql", env=self._get_psql_env(), stdin=file,
-            stdout=subprocess.PIPE)
-        p.communicate()
-        if p.returncode:
-            raise subprocess.CalledProcessError(p.returncode, "psql")
+        cmd = ["psql"]
+        if stop_on_error:
+            cmd.extend(["-v", "ON_ERROR_STOP=1"])
+        with open(os.devnull, "wb") as devnull:
+            call(cmd, env=self._get_psql_env(), stdin=file, stdout=devnull)
 
     def _call(self, cmd):
         cmd = cmd.format(**self.config.__dict__)
@@ -443,6 +1389,7 @@ class SetupDatabase(Bundle):
         pg_createcluster --start -e UTF-8 8.4 main
         """
         self.install_packages("postgresql-8.4-postgis postgresql-8.4 postgresql-contrib-8.4")
+        self.install_packages("python-psycopg2")
 
         if self.query_succeeds("select * from geometry_columns"):
             return
@@ -498,15 +1445,44 @@ class Osm2pgsqlBuild(Bundle, SVNCheckoutMixin):
             checkout_dir,
             self.config.OSM2PGSQL_SVN_URL,
             self.config.OSM2PGSQL_SVN_REVISION)
+        # Modification time of the executable, and whether it reads PBF.
+        self.pbf_support = (None, False)
 
     def system_setup(self):
+        # protobuf-c is needed for reading PBF files.
         self.install_packages(
             "subversion build-essential libxml2-dev libgeos-dev libpq-dev "
-            "libbz2-dev proj autoconf libtool")
+            "libbz2-dev proj autoconf libtool libprotobuf-c0-dev "
+            "protobuf-c-compiler")
 
     def download(self):
         self.fetch_svn()
 
+    def _clean_executable(self):
+        maybe_unlink(join(self.svn_checkout_dir, "osm2pgsql"))
+
+    def _get_build_inputs(self):
+        # configure only enables the PBF reader when protobuf-c is installed
+        # (the header moved in later versions of the package).
+        return ["/usr/include/google/protobuf-c/protobuf-c.h",
+            "/usr/include/protobuf-c/protobuf-c.h"]
+
+    def supports_pbf(self):
+        """Returns whether osm2pgsql was built with PBF support."""
+        executable = join(self.svn_checkout_dir, "osm2pgsql")
+        if not os.path.isfile(executable):
+            return False
+        mtime = os.path.getmtime(executable)
+        if self.pbf_support[0] != mtime:
+            output = subprocess.Popen([executable, "--help"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT).communicate()[0]
+            # Listed with the input readers.
+            self.pbf_support = (mtime, "pbf" in output)
+        return self.pbf_support[1]
+
+    @cached_step(config=("OSM2PGSQL_SVN_URL", "OSM2PGSQL_SVN_REVISION"),
+        files="_get_build_inputs", clean="_clean_executable")
     def build(self):
         if os.path.isfile(join(self.svn_checkout_dir, "osm2pgsql")):
             log.debug("Executable osm2pgsql already built")
@@ -522,6 +1498,42 @@ class Osm2pgsqlBuild(Bundle, SVNCheckoutMixin):
             cwd=self.svn_checkout_dir)
 
 
+class OsmconvertBuild(Bundle):
+    """
+    See http://wiki.openstreetmap.org/wiki/Osmconvert
+    """
+    OSMCONVERT_VERSION = "0.9"
+    RESOURCE = ("https://gitlab.com/osm-c-tools/osmctools/-/raw/%s/src/"
+        "osmconvert.c" % OSMCONVERT_VERSION, None, None)
+
+    def __init__(self, *args, **kwargs):
+        super(OsmconvertBuild, self).__init__(*args, **kwargs)
+        self.osmconvert_dir = join(self.executor.build_dir, "osmconvert")
+        self.osmconvert = join(self.osmconvert_dir, "osmconvert")
+
+    def system_setup(self):
+        self.install_packages("build-essential zlib1g-dev")
+
+    def download(self):
+        self.fetch_resources([self.RESOURCE])
+
+    def _get_source(self):
+        return [self.executor.fetcher.get_downloaded_path(self.RESOURCE)]
+
+    def _clean_executable(self):
+        maybe_unlink(self.osmconvert)
+
+    @cached_step(files="_get_source", clean="_clean_executable")
+    def build(self):
+        if os.path.isfile(self.osmconvert):
+            log.debug("Executable osmconvert already built")
+            return
+        if not os.path.isdir(self.osmconvert_dir):
+            make_dirs_as_project_owner(self.project_dir, self.osmconvert_dir)
+        call(["cc", "-O3", "-o", self.osmconvert] + self._get_source() +
+            ["-lz"])
+
+
 class Osmosis(Bundle):
     """
     See
@@ -530,11 +1542,23 @@ class Osmosis(Bundle):
     http://wiki.openstreetmap.org/wiki/Osmosis/Detailed_Usage
     """
     OSMOSIS_VER = "0.39"
+    # Tables to which the change files of replicate were applied.
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS replication (
+            sequence INTEGER NOT NULL,
+            tables_prefix TEXT NOT NULL,
+            applied_at REAL NOT NULL,
+            PRIMARY KEY (sequence, tables_prefix))""",
+    ]
 
     def __init__(self, *args, **kwargs):
         super(Osmosis, self).__init__(*args, **kwargs)
         self.work_dir = join(self.project_dir, "data", "osmosis")
         self.changes_file = join(self.work_dir, "changes.osm.gz")
+        # Change files read by replicate.
+        self.changes_dir = join(self.work_dir, "changes")
+        self.metadata = self.executor.metadata
+        self.metadata.create_tables(self.SCHEMA)
         self.osmosis = join(
             self.project_dir, "build", "osmosis-{0}".format(self.OSMOSIS_VER),
             "bin", "osmosis")
@@ -556,10 +1580,178 @@ class Osmosis(Bundle):
         call([self.osmosis, "--read-replication-interval-init",
             "workingDirectory=" + self.work_dir])
 
+    @contextlib.contextmanager
+    def _lock(self):
+        """Lock preventing replication commands from running at the same
+        time."""
+        lock = FileLock(join(self.work_dir, "replication.lock"),
+            blocking=False)
+        try:
+            lock.acquire()
+        except IOError, e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+            raise Exception("Replication is already running")
+        try:
+            yield
+        finally:
+            lock.release()
+
     def read_replication(self):
+        with self._lock():
+            self._read_replication(self.changes_file)
+
+    def _read_replication(self, changes_file):
         call([self.osmosis, "--read-replication-interval",
             "workingDirectory=" + self.work_dir, "--simplify-change",
-            "--write-xml-change", self.changes_file])
+            "--write-xml-change", changes_file])
+
+    def _read_state(self):
+        """Returns the sequence number and the timestamp (UTC) of the last
+        replication interval read."""
+        state = {}
+        for line in open(join(self.work_dir, "state.txt")):
+            if "=" in line and not line.startswith("#"):
+                key, value = line.strip().split("=", 1)
+                state[key] = value.replace("\\", "")
+        return (int(state["sequenceNumber"]), datetime.datetime.strptime(
+            state["timestamp"], "%Y-%m-%dT%H:%M:%SZ"))
+
+    def _get_changes_path(self, sequence):
+        return join(self.changes_dir, "changes-{0:09d}.osm.gz".format(sequence))
+
+    def _get_temp_changes_path(self, sequence):
+        """Path of the changes being read from the state sequence."""
+        return join(self.changes_dir,
+            "changes-from-{0:09d}.osm.gz.tmp".format(sequence))
+
+    def _read_changes(self, changes_queue, stop):
+        """Reads replication intervals into numbered change files, until
+        stop is set."""
+        while not stop.is_set():
+            sequence = self._read_state()[0]
+            temp_path = self._get_temp_changes_path(sequence)
+            # Partial changes of a failed read mustn't be applied.
+            try:
+                self._read_replication(temp_path)
+            except subprocess.CalledProcessError, e:
+                maybe_unlink(temp_path)
+                log.warn("Reading replication failed (%s), trying again in "
+                    "%s seconds", e, self.config.REPLICATION_INTERVAL)
+                stop.wait(self.config.REPLICATION_INTERVAL)
+                continue
+            except:
+                maybe_unlink(temp_path)
+                raise
+            # State of the interval just read, queued with its changes.
+            new_sequence, timestamp = self._read_state()
+            if new_sequence == sequence:
+                os.unlink(temp_path)
+                stop.wait(self.config.REPLICATION_INTERVAL)
+                continue
+            path = self._get_changes_path(new_sequence)
+            os.rename(temp_path, path)
+            # Blocks while the previous changes are being applied.
+            while not stop.is_set():
+                try:
+                    changes_queue.put((new_sequence, timestamp), timeout=0.5)
+                    break
+                except Queue.Full:
+                    pass
+
+    def _get_pending_changes(self):
+        """Returns the sequence numbers of the change files which were not
+        applied to all the tables."""
+        state = self._read_state()[0]
+        for temp_path in glob.glob(
+            join(self.changes_dir, "changes-from-*.osm.gz.tmp")):
+            sequence = int(re.search(r"changes-from-(\d+)",
+                temp_path).group(1))
+            # Interrupted after osmosis completed if the state moved past the
+            # sequence the read started from, otherwise the changes are
+            # partial.
+            path = self._get_changes_path(state)
+            if state > sequence and not os.path.isfile(path):
+                os.rename(temp_path, path)
+            else:
+                os.unlink(temp_path)
+
+        pending = []
+        for filename in sorted(os.listdir(self.changes_dir)):
+            match = re.match(r"changes-(\d+)\.osm\.gz$", filename)
+            if match:
+                pending.append(int(match.group(1)))
+        return pending
+
+    def _apply_changes(self, sequence, osmdata_bundles):
+        path = self._get_changes_path(sequence)
+        applied = set(r[0] for r in self.metadata.query(
+            "SELECT tables_prefix FROM replication WHERE sequence = ?",
+            sequence))
+
+        def apply(bundle):
+            bundle.load_replication(path)
+            self.metadata.execute("INSERT OR REPLACE INTO replication VALUES "
+                "(?, ?, ?)", sequence, bundle.tables_prefix, time.time())
+
+        # Tables are updated at the same time.
+        pool = WorkerPool(len(osmdata_bundles), "apply")
+        for bundle in osmdata_bundles:
+            if bundle.tables_prefix not in applied:
+                pool.submit(apply, bundle)
+        pool.join()
+        os.unlink(path)
+        self.metadata.execute(
+            "DELETE FROM replication WHERE sequence = ?", sequence)
+
+    def replicate(self):
+        """Applies the replication intervals to all the OSM tables, until
+        interrupted.
+
+        The next interval is read while the previous one is being applied.
+        Change files are kept until applied to all the tables, so that
+        replication resumes where it stopped.
+        """
+        osmdata_bundles = [b for b in self.executor.bundles if
+            isinstance(b, OsmData)]
+        if not osmdata_bundles:
+            raise Exception("No OSM tables to update, replicate must be run "
+                "on all bundles")
+        if not os.path.isdir(self.changes_dir):
+            make_dirs_as_project_owner(self.project_dir, self.changes_dir)
+
+        with self._lock():
+            for sequence in self._get_pending_changes():
+                log.info("Applying pending changes %d", sequence)
+                self._apply_changes(sequence, osmdata_bundles)
+
+            changes_queue = Queue.Queue(maxsize=1)
+            stop = threading.Event()
+            reader = threading.Thread(target=self._read_changes,
+                args=(changes_queue, stop), name="replication-reader")
+            reader.daemon = True
+            reader.start()
+            try:
+                while True:
+                    try:
+                        # Waiting with a timeout keeps Ctrl-C working.
+                        sequence, timestamp = changes_queue.get(timeout=0.5)
+                    except Queue.Empty:
+                        if not reader.is_alive():
+                            raise Exception("Reading replication stopped")
+                        continue
+                    start = time.time()
+                    self._apply_changes(sequence, osmdata_bundles)
+                    lag = datetime.datetime.utcnow() - timestamp
+                    log.info("Applied changes %d to %s in %.1f seconds, "
+                        "lag: %s", sequence, ", ".join(
+                            b.tables_prefix for b in osmdata_bundles),
+                        time.time() - start,
+                        datetime.timedelta(seconds=int(
+                            lag.days * 86400 + lag.seconds)))
+            finally:
+                stop.set()
+                reader.join()
 
 
 class OsmData(Bundle):
@@ -569,32 +1761,148 @@ class OsmData(Bundle):
     http://wiki.openstreetmap.org/wiki/Mapnik
     """
 
+    # Tables created by osm2pgsql, after the prefix.
+    TABLES = ["point", "line", "polygon", "roads"]
+    FIFO_CHUNK_SIZE = 1024 * 1024
+    import_lock = threading.Lock()
+
     def __init__(self, executor, tables_prefix):
         super(OsmData, self).__init__(executor)
 
         self.tables_prefix = tables_prefix
         self.name += "_" + self.tables_prefix
-        self.osm_resources = [(url,) for url in self.config.OSM_DATA_URLS]
         self.did_load_data = False
 
     @property
     def dependencies(self): 
         deps = [SetupDatabase, Osm2pgsqlBuild]
+        if self.config.OSM_DATA_CLIP:
+            deps.append(OsmconvertBuild)
         if self.config.USE_OSMOSIS:
             deps.append(Osmosis)
         return deps
 
+    @property
+    def osm_resources(self):
+        pbf = self._can_import_pbf()
+        return [(self._get_preferred_url(urls, pbf),) for
+            urls in self.config.OSM_DATA_URLS]
+
+    def _can_import_pbf(self):
+        """Returns whether PBF files can be imported: osmconvert converts
+        them when clipping, otherwise osm2pgsql must read them (assumed
+        until it is built)."""
+        if self.config.OSM_DATA_CLIP:
+            return True
+        osm2pgsql_bundle = self.executor.get_bundle("osm2pgsqlbuild")
+        return (not os.path.isfile(
+            join(osm2pgsql_bundle.svn_checkout_dir, "osm2pgsql")) or
+            osm2pgsql_bundle.supports_pbf())
+
+    def _get_preferred_url(self, urls, pbf=True):
+        """OSM_DATA_URLS items are either an url or a list of urls offering
+        the same data in several formats, of which PBF is preferred when it
+        can be imported."""
+        if isinstance(urls, basestring):
+            return urls
+        for url in urls:
+            if url.endswith(".pbf") == pbf:
+                return url
+        return urls[0]
+
     def download(self):
         self.fetch_resources(self.osm_resources)
 
     def download_clean(self):
         self.clean_resources(self.osm_resources)
 
-    def _call_osm2pgsql(self, args):
+    def _get_downloaded_paths(self):
+        return [self.executor.fetcher.get_downloaded_path(r) for
+            r in self.osm_resources]
+
+    def _get_clip_format(self):
+        """Returns the format of the clipped files: pbf if osm2pgsql can read
+        it, osm otherwise."""
+        if self.executor.get_bundle("osm2pgsqlbuild").supports_pbf():
+            return "pbf"
+        return "osm"
+
+    def _get_clipped_path(self, resource, format):
+        extent = ",".join(repr(c) for c in self.config.EXTENT)
+        return self.executor.fetcher.get_derived_path(resource,
+            "clip-{0}.{1}".format(hashlib.sha1(extent).hexdigest()[:12],
+            "osm.pbf" if format == "pbf" else "osm"))
+
+    def _clip(self, resource, format):
+        """Writes the data of the downloaded resource within EXTENT to a
+        file next to it, once per content, extent and format."""
+        path = self.executor.fetcher.get_downloaded_path(resource)
+        clipped_path = self._get_clipped_path(resource, format)
+        if os.path.isfile(clipped_path):
+            return
+        log.info("Clipping %s", path)
+        osmconvert_bundle = self.executor.get_bundle("osmconvertbuild")
+        cmd = [osmconvert_bundle.osmconvert,
+            "-b=" + ",".join(str(c) for c in self.config.EXTENT),
+            "--out-" + format, "-o=" + clipped_path + ".tmp"]
+        decompress_cmd = self._get_decompress_command(path)
+        if decompress_cmd:
+            # osmconvert doesn't read bzip2, and can only complete the ways
+            # crossing the border when it can read the file twice.
+            p = subprocess.Popen(decompress_cmd, stdout=subprocess.PIPE)
+            try:
+                call(cmd + ["-"], stdin=p.stdout)
+            finally:
+                p.stdout.close()
+                p.wait()
+            if p.returncode:
+                raise subprocess.CalledProcessError(p.returncode,
+                    decompress_cmd)
+        else:
+            call(cmd + ["--complete-ways", path])
+        os.rename(clipped_path + ".tmp", clipped_path)
+
+    def _clip_inputs(self):
+        format = self._get_clip_format()
+        pool = WorkerPool(len(self.osm_resources), "clip")
+        for resource in self.osm_resources:
+            pool.submit(self._clip, resource, format)
+        pool.join()
+
+    def _get_input_paths(self):
+        """Returns the files to import (see _clip_inputs)."""
+        if not self.config.OSM_DATA_CLIP:
+            return self._get_downloaded_paths()
+        format = self._get_clip_format()
+        return [self._get_clipped_path(r, format) for r in self.osm_resources]
+
+    def _get_style_path(self):
         osm2pgsql_bundle = self.executor.get_bundle("osm2pgsqlbuild")
-        style_path = self.config.OSM_DATA_STYLE_PATH.get(
+        return self.config.OSM_DATA_STYLE_PATH.get(
             self.tables_prefix,
             join(osm2pgsql_bundle.svn_checkout_dir, "default.style"))
+
+    def _get_step_inputs(self):
+        return self._get_downloaded_paths() + [self._get_style_path()]
+
+    def _get_import_settings(self, concurrent):
+        """Settings of the database user while importing. concurrent is the
+        number of osm2pgsql processes running at the same time."""
+        settings = dict(self.config.OSM_IMPORT_DB_SETTINGS)
+        maintenance_work_mem = self.config.OSM_IMPORT_MAINTENANCE_WORK_MEM
+        if maintenance_work_mem is None:
+            # osm2pgsql frees its cache, then indexes the tables at the same
+            # time. 2047MB is the maximum of PostgreSQL 8.4.
+            maintenance_work_mem = max(16, min(get_available_memory() / 2 /
+                (len(self.TABLES) * concurrent), 2047))
+        settings["maintenance_work_mem"] = "{0}MB".format(maintenance_work_mem)
+        return settings
+
+    def _call_osm2pgsql(self, args, concurrent=1):
+        """Runs osm2pgsql. concurrent is the number of osm2pgsql processes
+        running at the same time, which share the memory and cores."""
+        osm2pgsql_bundle = self.executor.get_bundle("osm2pgsqlbuild")
+        style_path = self._get_style_path()
         cmd = [
             join(osm2pgsql_bundle.svn_checkout_dir, "osm2pgsql"),
             "-H", self.config.DB_HOST,
@@ -605,8 +1913,19 @@ class OsmData(Bundle):
             "--bbox", ",".join(str(c) for c in self.config.EXTENT),
             "-S", style_path,
         ]
+        cache = self.config.OSM2PGSQL_CACHE
+        if cache is None:
+            # The remaining memory is left to PostgreSQL.
+            cache = max(100, get_available_memory() * 3 / 4 / concurrent)
+        cmd.extend(["-C", str(cache)])
+        if any(arg.endswith(".pbf") for arg in args):
+            cmd.extend(["-r", "pbf"])
         if self.config.OSM2PGSQL_SLIM_MODE:
             cmd.append("--slim")
+            processes = self.config.OSM2PGSQL_PROCESSES
+            if processes is None:
+                processes = max(1, multiprocessing.cpu_count() / concurrent)
+            cmd.extend(["--number-processes", str(processes)])
         cmd.extend(args)
 
         env = os.environ.copy()
@@ -615,34 +1934,212 @@ class OsmData(Bundle):
         log.info("osm2pgsql command: %s", cmd)
         call(cmd, env=env)
 
-    def load_data(self):
+    def _get_table_names(self):
+        return ["{0}_{1}".format(self.tables_prefix, t) for t in self.TABLES]
+
+    def _tables_exist(self):
         db_bundle = self.executor.get_bundle("setupdatabase")
+        tables = self._get_table_names()
+        return len(db_bundle.get_existing_tables(tables)) == len(tables)
+
+    def _get_shared_import_bundles(self):
+        """Returns the other loaded OsmData bundles with the same input files
+        which need to be imported. Their tables are dropped if they exist."""
+        bundles = []
+        for bundle in self.executor.bundles:
+            if (not isinstance(bundle, OsmData) or bundle is self or
+                bundle.did_load_data or
+                bundle.osm_resources != self.osm_resources):
+                continue
+            tables_exist = bundle._tables_exist()
+            if tables_exist:
+                if self.executor.steps.is_current(bundle, "_load_data"):
+                    continue
+                bundle.load_data_clean()
+            bundles.append(bundle)
+        return bundles
+
+    def _get_decompress_command(self, path):
+        if path.endswith(".bz2"):
+            programs = ("lbzip2", "pbzip2", "bzip2")
+        elif path.endswith(".gz"):
+            programs = ("pigz", "gzip")
+        else:
+            return None
+        # Prefer multi-threaded decompressors when they are installed.
+        for program in programs:
+            if find_executable(program):
+                return [program, "-dc", path]
+        return [programs[-1], "-dc", path]
+
+    def _open_fifo(self, path, failed):
+        # Opening a fifo blocks until it is opened for reading, which doesn't
+        # happen if osm2pgsql failed.
+        while True:
+            try:
+                fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+                break
+            except OSError, e:
+                if e.errno != errno.ENXIO:
+                    raise
+            if failed.is_set():
+                raise Exception("osm2pgsql failed, stopping the import")
+            time.sleep(0.1)
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+            fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(fd, "wb")
+
+    def _write_inputs(self, fifos, failed):
+        """Writes each input file, decompressed once, to all its fifos."""
+        for path, targets in zip(self._get_input_paths(), fifos):
+            log.info("Reading %s", path)
+            cmd = self._get_decompress_command(path)
+            if cmd:
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                source = p.stdout
+            else:
+                p = None
+                source = open(path, "rb")
+            outputs = []
+            try:
+                for target in targets:
+                    outputs.append(self._open_fifo(target, failed))
+                while True:
+                    data = source.read(self.FIFO_CHUNK_SIZE)
+                    if not data:
+                        break
+                    for output in outputs:
+                        output.write(data)
+            finally:
+                for output in outputs:
+                    output.close()
+                source.close()
+                if p:
+                    p.wait()
+            if p and p.returncode:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+
+    def _load_shared(self, bundles):
+        """Imports the input files into the tables of several bundles at the
+        same time. The files are read and decompressed once, and written to
+        a fifo per osm2pgsql process."""
+        log.info("Importing the tables %s from the same input",
+            ", ".join(b.tables_prefix for b in bundles))
+        fifo_dir = join(self.project_dir, "data", "import_fifos")
+        maybe_unlink(fifo_dir)
+        make_dirs_as_project_owner(self.project_dir, fifo_dir)
+
+        # Fifos are named like the decompressed files, as osm2pgsql uses
+        # the extension to find their format.
+        names = [re.sub(r"\.(bz2|gz)$", "", os.path.basename(path)) for
+            path in self._get_input_paths()]
+        bundle_fifos = []
+        for bundle in bundles:
+            fifos = []
+            for i, name in enumerate(names):
+                fifo = join(fifo_dir, "{0}-{1}-{2}".format(
+                    bundle.tables_prefix, i, name))
+                os.mkfifo(fifo)
+                fifos.append(fifo)
+            bundle_fifos.append(fifos)
+
+        failed = threading.Event()
+        def load(bundle, fifos):
+            try:
+                bundle._call_osm2pgsql(fifos, concurrent=len(bundles))
+            except Exception:
+                failed.set()
+                raise
+
+        pool = WorkerPool(len(bundles) + 1, "import")
+        for bundle, fifos in zip(bundles, bundle_fifos):
+            pool.submit(load, bundle, fifos)
+        pool.submit(self._write_inputs, zip(*bundle_fifos), failed)
+        try:
+            pool.join()
+        except:
+            error = sys.exc_info()
+            # The other imports got a truncated input, don't leave their
+            # tables behind to be taken for complete ones.
+            log.info("Dropping the tables of the shared import")
+            for bundle in bundles:
+                bundle.load_data_clean()
+            raise error[0], error[1], error[2]
+        finally:
+            maybe_unlink(fifo_dir)
+
+    def load_data(self):
+        # A bundle importing the tables of other bundles (see _load_shared)
+        # holds the lock, so that these don't start their own import.
+        with OsmData.import_lock:
+            self._load_data()
+
+    # The config is listed since nothing is read when the tables exist.
+    @cached_step(config=("OSM_DATA_URLS", "EXTENT", "SRID_OSM",
+        "OSM_DATA_CLIP", "OSM_DATA_STYLE_PATH", "OSM2PGSQL_SLIM_MODE",
+        "DB_HOST", "DB_PORT", "DB_NAME"), files="_get_step_inputs",
+        upstream=("osm2pgsqlbuild.build",), clean="load_data_clean")
+    def _load_data(self):
         # Assumes that if all the osm tables are present, the import doesn't
         # need to run.
-        if all([db_bundle.query_succeeds(
-            'select * from "{0}_{1}" limit 1'.format(self.tables_prefix, t)) for
-            t in ["point", "line", "polygon", "roads"]]):
+        if self._tables_exist():
             return
 
-        args = []
-        for r in self.osm_resources:
-            args.append(self.executor.fetcher.get_downloaded_path(r))
-        self._call_osm2pgsql(args)
+        # The XML files are only downloaded here when osm2pgsql turned out
+        # not to read PBF.
+        self.fetch_resources(self.osm_resources)
+        if self.config.OSM_DATA_CLIP:
+            self._clip_inputs()
+        if len(set(p.endswith(".pbf") for p in self._get_input_paths())) > 1:
+            # osm2pgsql reads all its input files with the same reader.
+            raise Exception("PBF and XML files can't be imported together "
+                "(unless OSM_DATA_CLIP is set)")
+        bundles = []
+        if self.config.OSM_DATA_SHARED_IMPORT:
+            bundles = self._get_shared_import_bundles()
+        db_bundle = self.executor.get_bundle("setupdatabase")
+        with db_bundle.user_settings(
+            self._get_import_settings(1 + len(bundles))):
+            if bundles:
+                self._load_shared([self] + bundles)
+            else:
+                self._call_osm2pgsql(self._get_input_paths())
+        for bundle in bundles:
+            bundle.did_load_data = True
+            self.executor.steps.record(
+                bundle, "_load_data", step_context.stack[-1])
 
         self.did_load_data = True
 
     def load_data_clean(self):
         db_bundle = self.executor.get_bundle("setupdatabase")
 
-        for table in ["point", "line", "polygon", "roads"]:
+        existing = db_bundle.get_existing_tables(self._get_table_names())
+        for table in sorted(existing):
             db_bundle.execute_sql(
-                "select DropGeometryTable('{prefix}_{table}')".format(
-                    prefix=self.tables_prefix,
-                    table=table))
+                "select DropGeometryTable('{0}')".format(table))
 
-    def load_replication(self):
+    def load_replication(self, changes_file=None):
         osmosis_bundle = self.executor.get_bundle("osmosis")
-        self._call_osm2pgsql(["--append", osmosis_bundle.changes_file])
+        args = ["--append", changes_file or osmosis_bundle.changes_file]
+        expired_path = join(osmosis_bundle.work_dir,
+            "expired_{0}.list".format(self.tables_prefix))
+        if self.config.USE_TILECACHE:
+            # osm2pgsql appends to the file, which keeps the tiles of a
+            # previous run if their expiry failed.
+            args.extend(["-e", "{0}-{1}".format(self.config.EXPIRE_ZOOM_FROM,
+                self.config.EXPIRE_ZOOM_TO), "-o", expired_path])
+        self._call_osm2pgsql(args)
+
+        if self.config.USE_TILECACHE and os.path.isfile(expired_path):
+            # TileCache isn't loaded when load_replication runs on this
+            # bundle only.
+            tilecaches = [b for b in self.executor.bundles if
+                isinstance(b, TileCache)]
+            tilecache = (tilecaches[0] if tilecaches else
+                TileCache(self.executor))
+            tilecache.expire(self.tables_prefix, expired_path)
+            os.unlink(expired_path)
 
 
 class SRTMData(Bundle):
@@ -667,12 +2164,23 @@ class SRTMData(Bundle):
     # (247M vs 15M on some data I tested).
     NO_DATA_VALUE = -32768
 
+    CONTOURS_INTERVAL = 10
+    GEOCOLUMN = "way"
+
+    # Pixel size of the hill shading, in meters.
+    HILLSHADING_RESOLUTION = 30
+    # Width and height, in pixels, of the windows shaded at the same time.
+    HILLSHADING_WINDOW_SIZE = 2048
+
     def __init__(self, executor):
         super(SRTMData, self).__init__(executor)
         self.srtm_dir = join(self.project_dir, "data", "srtm")
         make_dirs_as_project_owner(self.project_dir, self.srtm_dir)
 
-        self.downloader = srtm.SRTMDownloader(cachedir=self.srtm_dir)
+        self.downloader = srtm.SRTMDownloader(
+            server=self.config.SRTM_SERVER,
+            directory=self.config.SRTM_DIRECTORY,
+            cachedir=self.srtm_dir)
 
         self.tiles_coordinates = []
         minx, miny, maxx, maxy = self.config.EXTENT
@@ -680,6 +2188,13 @@ class SRTMData(Bundle):
             for y in range(int(math.floor(miny)), int(math.ceil(maxy))):
                 self.tiles_coordinates.append((x, y))
 
+        # Tiles resized to SRTM_RESIZE_DIMENSION.
+        self.resized_dir = join(self.srtm_dir, "resized")
+        # Contours of the tiles being loaded.
+        self.contours_dir = join(self.srtm_dir, "contours_tiles")
+        # Windows of the hill shading being generated.
+        self.hillshading_dir = join(self.srtm_dir, "hillshading_tiles")
+
         self.perrygeo_dir = join(self.project_dir, "build", "perrygeo")
         self.hillshade = join(self.perrygeo_dir, "demtools", "bin", "hillshade")
 
@@ -706,8 +2221,9 @@ class SRTMData(Bundle):
 
         # NASA tiles.
         self.downloader.loadFileList()
-        for (x, y) in self.tiles_coordinates:
-            self.downloader.getTile(y, x)
+        self.downloader.downloadTiles(
+            [(y, x) for (x, y) in self.tiles_coordinates],
+            jobs=self.config.DOWNLOAD_JOBS)
 
         if not self.config.USE_HILLSHADING:
             return
@@ -730,119 +2246,339 @@ class SRTMData(Bundle):
 
         call("make", cwd=join(self.perrygeo_dir, "demtools"))
 
-    def _build_merged_hgt(self):
-        if os.path.isfile(join(self.srtm_dir, "contours.hgt")):
+    def _get_tile_paths(self):
+        self.downloader.loadFileList()
+        return [join(self.srtm_dir, self.downloader.filelist[y, x][1]) for
+            (x, y) in self.tiles_coordinates]
+
+    def _clean_mosaic(self):
+        maybe_unlink(join(self.srtm_dir, "contours.vrt"))
+        maybe_unlink(self.resized_dir)
+
+    def _resize_tile(self, source, target):
+        maybe_unlink(target + ".tmp")
+        call(["gdalwarp", "-of", "GTiff", "-co", "TILED=YES",
+            "-co", "COMPRESS=DEFLATE", "-co", "PREDICTOR=2",
+            "-rcs", "-order", "3",
+            "-ts", str(self.config.SRTM_RESIZE_DIMENSION),
+            str(self.config.SRTM_RESIZE_DIMENSION), source, target + ".tmp"])
+        os.rename(target + ".tmp", target)
+
+    @cached_step(config=("EXTENT", "SRTM_RESIZE_DIMENSION"),
+        files="_get_tile_paths", clean="_clean_mosaic")
+    def _build_mosaic(self):
+        """Build contours.vrt, a virtual mosaic reading the .hgt files
+        straight from the downloaded zips."""
+        if os.path.isfile(join(self.srtm_dir, "contours.vrt")):
             return
 
         # Clean previously generated files.
         for p in glob.glob(join(self.srtm_dir, "contours*")):
             if "contours_hillshading.tif" in p:
                 continue
-            os.unlink(p)
+            maybe_unlink(p)
+        maybe_unlink(self.resized_dir)
 
-        log.info("Uncompressing .hgt files")
-        to_merge = []
+        sources = []
         self.downloader.loadFileList()
         for (x, y) in self.tiles_coordinates:
             _, filename = self.downloader.filelist[y, x]
-            call(["unzip", "-qo", filename], cwd=self.srtm_dir)
-            to_merge.append(filename.replace(".zip", ""))
+            sources.append("/vsizip/{0}/{1}".format(
+                join(self.srtm_dir, filename), filename.replace(".zip", "")))
 
         if self.config.SRTM_RESIZE_DIMENSION > 0:
             # Reduce size of .hgt files.
             log.info("Warping .hgt files")
-            for f in to_merge:
-                maybe_unlink(join(self.srtm_dir, f + "_tmp"))
-                call("gdalwarp -rcs -order 3 -ts {width} {height} -multi "
-                    "{input} {output}".format(
-                    width=self.config.SRTM_RESIZE_DIMENSION,
-                    height=self.config.SRTM_RESIZE_DIMENSION,
-                    input=f, output=f + "_tmp"),
-                    shell=True, cwd=self.srtm_dir)
-                maybe_unlink(join(self.srtm_dir, f))
-                os.rename(
-                    join(self.srtm_dir, f + "_tmp"),
-                    join(self.srtm_dir, f))
-
-        log.info("Merging .hgt files together")
-        call(["gdal_merge.py", "-o", "contours.hgt"] + to_merge,
+            os.mkdir(self.resized_dir)
+            pool = WorkerPool(
+                self.config.SRTM_JOBS or multiprocessing.cpu_count(), "warp")
+            resized = []
+            for source in sources:
+                target = join(self.resized_dir,
+                    os.path.basename(source).replace(".hgt", ".tif"))
+                pool.submit(self._resize_tile, source, target)
+                resized.append(target)
+            pool.join()
+            sources = resized
+
+        log.info("Building the mosaic of .hgt files")
+        maybe_unlink(join(self.srtm_dir, "contours.vrt.tmp"))
+        call(["gdalbuildvrt", "-of", "VRT", "contours.vrt.tmp"] + sources,
             cwd=self.srtm_dir)
-        for p in glob.glob(join(self.srtm_dir, "[NS]*hgt")):
+        os.rename(join(self.srtm_dir, "contours.vrt.tmp"),
+            join(self.srtm_dir, "contours.vrt"))
+
+    def _drop_contours_table(self):
+        db_bundle = self.executor.get_bundle("setupdatabase")
+        if db_bundle.get_existing_tables([self.CONTOURS_TABLE]):
+            db_bundle.execute_sql(
+                "select DropGeometryTable('{0}')".format(self.CONTOURS_TABLE))
+
+    def _get_contour_windows(self):
+        """Returns (name, srcwin) pairs splitting contours.vrt by SRTM tile.
+
+        Windows include the pixels on both edges of their tile, so that
+        neighbouring windows share a row or column of pixels where their
+        contour lines join.
+        """
+        vrt = xml.etree.ElementTree.parse(
+            join(self.srtm_dir, "contours.vrt")).getroot()
+        width = int(vrt.get("rasterXSize"))
+        height = int(vrt.get("rasterYSize"))
+        origin_x, pixel_x, _, origin_y, _, pixel_y = [
+            float(v) for v in vrt.find("GeoTransform").text.split(",")]
+
+        def column(lon):
+            return int(round((lon - origin_x) / pixel_x - 0.5))
+
+        def row(lat):
+            return int(round((lat - origin_y) / pixel_y - 0.5))
+
+        windows = []
+        for (x, y) in self.tiles_coordinates:
+            left, right = max(column(x), 0), min(column(x + 1), width - 1)
+            top, bottom = max(row(y + 1), 0), min(row(y), height - 1)
+            windows.append(("{0}_{1}".format(x, y),
+                (left, top, right - left + 1, bottom - top + 1)))
+        return windows
+
+    def _load_contours(self, shapefile, *options):
+        """Load shapefile into the contours table with the given shp2pgsql
+        options (-p creates the table, -a appends)."""
+        db_bundle = self.executor.get_bundle("setupdatabase")
+        shp2pgsql = subprocess.Popen(["shp2pgsql"] + list(options) +
+            ["-s", str(self.config.SRID_OSM), "-g", self.GEOCOLUMN,
+            shapefile, self.CONTOURS_TABLE], stdout=subprocess.PIPE)
+        try:
+            db_bundle.execute_sql_file(shp2pgsql.stdout, stop_on_error=True)
+        finally:
+            # Lets shp2pgsql exit when psql stopped reading.
+            shp2pgsql.stdout.close()
+            shp2pgsql.wait()
+        if shp2pgsql.returncode:
+            raise subprocess.CalledProcessError(shp2pgsql.returncode,
+                "shp2pgsql")
+
+    def _generate_contours(self, name, window, create_table):
+        """Generate the contours of a window of the mosaic, reproject them
+        and load them into the database."""
+        path = join(self.contours_dir, name)
+        call(["gdal_translate", "-q", "-of", "VRT", "-srcwin"] +
+            [str(v) for v in window] +
+            [join(self.srtm_dir, "contours.vrt"), path + ".vrt"])
+        call(["gdal_contour", "-i", str(self.CONTOURS_INTERVAL),
+            "-snodata", str(self.NO_DATA_VALUE), "-a", "height",
+            path + ".vrt", path + ".shp"])
+        call(["ogr2ogr", "-t_srs", "EPSG:{0}".format(self.config.SRID_OSM),
+            path + "_reprojected.shp", path + ".shp"])
+        create_table(path + "_reprojected.shp")
+        # Rows are sent with COPY (-D) rather than one INSERT each.
+        self._load_contours(path + "_reprojected.shp", "-a", "-D")
+        for p in glob.glob(path + ".*") + glob.glob(path + "_reprojected.*"):
             os.unlink(p)
 
+    @cached_step(config=("EXTENT", "SRID_OSM", "DB_HOST", "DB_PORT",
+        "DB_NAME"), upstream=("srtmdata._build_mosaic",),
+        clean="_drop_contours_table")
     def _populate_database_table(self):
         db_bundle = self.executor.get_bundle("setupdatabase")
         # Assumes that if all the contours table is present, the import doesn't
         # need to run.
-        if db_bundle.query_succeeds(
-            'select * from "{0}" limit 1'.format(self.CONTOURS_TABLE)):
+        if db_bundle.get_existing_tables([self.CONTOURS_TABLE]):
             log.info("Contours table already there, bailing out.")
             return
 
-        CONTOURS_INTERVAL = 10
-
-        log.info("Generating contours shapefile")
-        for ext in ("shp", "shx", "dbf", "prj"):
-            maybe_unlink(join(self.srtm_dir, "contours." + ext))
-        call("gdal_contour -i {0} -snodata {1} -a height contours.hgt "
-            "contours.shp".format(CONTOURS_INTERVAL, self.NO_DATA_VALUE),
-            shell=True, cwd=self.srtm_dir)
-
-        log.info("Reprojecting shapfile")
-        call("ogr2ogr -t_srs EPSG:{0} contours_reprojected.shp contours.shp".
-            format(self.config.SRID_OSM),
-            shell=True, cwd=self.srtm_dir)
-
-        GEOCOLUMN = "way"
+        windows = self._get_contour_windows()
+        log.info("Generating contours of %d tiles", len(windows))
+        maybe_unlink(self.contours_dir)
+        os.mkdir(self.contours_dir)
+
+        # The table is created from the first reprojected shapefile.
+        created = []
+        create_lock = threading.Lock()
+
+        def create_table(shapefile):
+            with create_lock:
+                if not created:
+                    self._load_contours(shapefile, "-p")
+                    created.append(shapefile)
+
+        pool = WorkerPool(
+            self.config.SRTM_JOBS or multiprocessing.cpu_count(), "contours")
+        for name, window in windows:
+            pool.submit(self._generate_contours, name, window, create_table)
+        try:
+            pool.join()
+        except:
+            # Don't leave partially loaded contours behind.
+            if created:
+                self._drop_contours_table()
+            raise
+        os.rmdir(self.contours_dir)
+
+        log.info("Indexing contours")
+        db_bundle.execute_sql(
+            'CREATE INDEX "{0}_{1}_gist" ON "{0}" USING GIST ("{1}")'.format(
+            self.CONTOURS_TABLE, self.GEOCOLUMN))
+        db_bundle.execute_sql('ANALYZE "{0}"'.format(self.CONTOURS_TABLE))
 
-        log.info("Converting shape and loading sql")
-        shp2pgsqlPopen = subprocess.Popen(
-            "shp2pgsql -s {srid} -g {geocolumn} -I "
-            "contours_reprojected.shp {table}".format(
-                srid=self.config.SRID_OSM,
-                geocolumn=GEOCOLUMN,
-                table=self.CONTOURS_TABLE),
-            shell=True,
-            cwd=self.srtm_dir,
-            stdout=subprocess.PIPE)
+    def _get_generalized_tables(self):
+        return ["{0}_{1}".format(self.CONTOURS_TABLE, interval) for
+            (interval, _, _, _) in self.config.CONTOURS_GENERALIZED]
 
-        db_bundle.execute_sql_file(shp2pgsqlPopen.stdout)
+    def _drop_generalized_contours(self):
+        db_bundle = self.executor.get_bundle("setupdatabase")
+        existing = db_bundle.get_existing_tables(
+            self._get_generalized_tables())
+        for table in sorted(existing):
+            db_bundle.execute_sql(
+                "select DropGeometryTable('{0}')".format(table))
 
+    def _create_generalized_table(self, table, interval, tolerance):
+        db_bundle = self.executor.get_bundle("setupdatabase")
+        db_bundle.execute_sql(";\n".join([
+            'CREATE TABLE "{0}" AS SELECT gid, height, '
+                'ST_SimplifyPreserveTopology("{1}", {2}) AS "{1}" '
+                'FROM "{3}" WHERE CAST(height AS integer) % {4} = 0'.format(
+                table, self.GEOCOLUMN, tolerance, self.CONTOURS_TABLE,
+                interval),
+            'CREATE INDEX "{0}_{1}_gist" ON "{0}" USING GIST ("{1}")'.format(
+                table, self.GEOCOLUMN),
+            "SELECT Populate_Geometry_Columns('\"{0}\"'::regclass)".format(
+                table),
+            'ANALYZE "{0}"'.format(table),
+        ]))
+
+    @cached_step(config=("CONTOURS_GENERALIZED",),
+        upstream=("srtmdata._populate_database_table",),
+        clean="_drop_generalized_contours")
+    def _build_generalized_contours(self):
+        """Build the tables of CONTOURS_GENERALIZED from the contours table,
+        at the same time."""
+        for (interval, _, _, _) in self.config.CONTOURS_GENERALIZED:
+            if interval % self.CONTOURS_INTERVAL:
+                raise Exception("Contours interval {0} isn't a multiple of "
+                    "{1}".format(interval, self.CONTOURS_INTERVAL))
+        self._drop_generalized_contours()
+        tables = self._get_generalized_tables()
+        log.info("Generalizing contours into %s", ", ".join(tables))
+        pool = WorkerPool(len(tables), "generalize")
+        for table, (interval, tolerance, _, _) in zip(tables,
+            self.config.CONTOURS_GENERALIZED):
+            pool.submit(self._create_generalized_table, table, interval,
+                tolerance)
+        pool.join()
+
+    def _clean_hillshading(self):
+        maybe_unlink(join(self.srtm_dir, "contours_hillshading.tif"))
+        maybe_unlink(self.hillshading_dir)
+
+    def _get_hillshading_windows(self):
+        """Returns the bounding boxes, in pixels of the hill shading, of the
+        windows shaded separately, and the size of the hill shading."""
+        xs = [x for (x, y) in self.tiles_coordinates]
+        ys = [y for (x, y) in self.tiles_coordinates]
+        minx, miny, maxx, maxy = convert_bbox(SRID_LATLON, 900913,
+            (min(xs), min(ys), max(xs) + 1, max(ys) + 1))
+        resolution = self.HILLSHADING_RESOLUTION
+        origin = (math.floor(minx / resolution) * resolution,
+            math.ceil(maxy / resolution) * resolution)
+        width = int(math.ceil((maxx - origin[0]) / resolution))
+        height = int(math.ceil((origin[1] - miny) / resolution))
+
+        size = self.HILLSHADING_WINDOW_SIZE
+        windows = []
+        for left in range(0, width, size):
+            for top in range(0, height, size):
+                windows.append((left, top,
+                    min(left + size, width), min(top + size, height)))
+        return origin, windows
+
+    def _shade_window(self, origin, window):
+        """Warp a window of the mosaic with a one pixel margin, shade it, and
+        return a VRT of the shaded window without the margin."""
+        resolution = self.HILLSHADING_RESOLUTION
+        left, top, right, bottom = window
+        path = join(self.hillshading_dir, "{0}_{1}".format(left, top))
+        call(["gdalwarp", "-q", "-co", "TILED=YES",
+            "-srcnodata", str(self.NO_DATA_VALUE),
+            "-t_srs", "+init=esri.extra:900913",
+            "-te"] + [str(c) for c in (
+                origin[0] + (left - 1) * resolution,
+                origin[1] - (bottom + 1) * resolution,
+                origin[0] + (right + 1) * resolution,
+                origin[1] - (top - 1) * resolution)] +
+            ["-tr", str(resolution), str(resolution),
+            "-rcs", "-order", "3", join(self.srtm_dir, "contours.vrt"),
+            path + "_warped.tif"])
+        call([self.hillshade, path + "_warped.tif", path + "_shaded.tif",
+            "-z2"])
+        os.unlink(path + "_warped.tif")
+        call(["gdal_translate", "-q", "-of", "VRT", "-srcwin", "1", "1",
+            str(right - left), str(bottom - top), path + "_shaded.tif",
+            path + ".vrt"])
+        return path + ".vrt"
+
+    @cached_step(config=("EXTENT",), upstream=("srtmdata._build_mosaic",),
+        clean="_clean_hillshading")
     def _create_hillshading(self):
         if os.path.isfile(join(self.srtm_dir, "contours_hillshading.tif")):
             return
 
         # TODO: create options for some of the parameters
 
-        maybe_unlink(join(self.srtm_dir, "contours.tif"))
-        call('gdal_translate -co "TILED=YES" contours.hgt contours.tif',
-            shell=True, cwd=self.srtm_dir)
-
-        maybe_unlink(join(self.srtm_dir, "contours_warped.tif"))
-        call('gdalwarp -co "TILED=YES" -srcnodata {0} '
-            '-t_srs "+init=esri.extra:900913" '
-            '-rcs -order 3 -tr 30 30 -multi contours.tif contours_warped.tif'.
-            format(self.NO_DATA_VALUE),
-            shell=True, cwd=self.srtm_dir)
-
-        call(self.hillshade + " contours_warped.tif contours_hillshading.tif -z2",
-            shell=True, cwd=self.srtm_dir)
+        origin, windows = self._get_hillshading_windows()
+        log.info("Shading %d windows", len(windows))
+        maybe_unlink(self.hillshading_dir)
+        os.mkdir(self.hillshading_dir)
+        shaded = []
+
+        def shade(window):
+            shaded.append(self._shade_window(origin, window))
+
+        pool = WorkerPool(
+            self.config.SRTM_JOBS or multiprocessing.cpu_count(), "shade")
+        for window in windows:
+            pool.submit(shade, window)
+        pool.join()
+
+        log.info("Merging and compressing the hill shading")
+        mosaic = join(self.hillshading_dir, "hillshading.vrt")
+        output = join(self.srtm_dir, "contours_hillshading.tif.tmp")
+        call(["gdalbuildvrt", "-q", mosaic] + sorted(shaded))
+        call(["gdal_translate", "-q", "-of", "GTiff", "-co", "TILED=YES",
+            "-co", "COMPRESS=DEFLATE", mosaic, output])
+
+        # Overviews are added down to a size of about one tile.
+        width = max(w[2] for w in windows)
+        height = max(w[3] for w in windows)
+        levels = []
+        level = 2
+        while max(width, height) / level >= 256:
+            levels.append(str(level))
+            level *= 2
+        if levels:
+            log.info("Adding overviews")
+            call(["gdaladdo", "-r", "average",
+                "--config", "COMPRESS_OVERVIEW", "DEFLATE", output] + levels)
+
+        os.rename(output, join(self.srtm_dir, "contours_hillshading.tif"))
+        maybe_unlink(self.hillshading_dir)
 
     def load_data(self):
-        self._build_merged_hgt()
+        self._build_mosaic()
 
         self._populate_database_table()
+        self._build_generalized_contours()
 
         if self.config.USE_HILLSHADING:
             self._create_hillshading()
 
     def load_data_clean(self):
-        maybe_unlink(join(self.srtm_dir, "contours.hgt"))
-        maybe_unlink(join(self.srtm_dir, "contours_hillshading.tif"))
-
-        db_bundle = self.executor.get_bundle("setupdatabase")
-        db_bundle.execute_sql(
-            "select DropGeometryTable('{0}')".format(self.CONTOURS_TABLE))
+        self._clean_mosaic()
+        self._clean_hillshading()
+        self._drop_generalized_contours()
+        self._drop_contours_table()
 
 
 class MapnikConfig(Bundle, SVNCheckoutMixin):
@@ -872,20 +2608,24 @@ class MapnikConfig(Bundle, SVNCheckoutMixin):
     def system_setup(self):
         self.install_packages("python-mapnik")
 
+    WORLD_BOUNDARIES_DIR = "data/world_boundaries"
+    # Also used by MapserverConfig. The download cache makes sure that they
+    # are only downloaded and extracted once.
+    DATA_RESOURCES = [
+        ("http://tile.openstreetmap.org/world_boundaries-spherical.tgz",
+            "data", "4feb2f60a37bbe4e8a33596befcd0a1c"),
+        ("http://tile.openstreetmap.org/processed_p.tar.bz2",
+            WORLD_BOUNDARIES_DIR),
+        ("http://tile.openstreetmap.org/shoreline_300.tar.bz2",
+            WORLD_BOUNDARIES_DIR),
+        ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/download/10m/cultural/10m-populated-places.zip",
+            WORLD_BOUNDARIES_DIR, "ba61ef461732bbd85fea18deafb6db8c"),
+        ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/110m-admin-0-boundary-lines.zip",
+            WORLD_BOUNDARIES_DIR, "1d116cde1491e514f3f49224682f82b5"),
+    ]
+
     def download(self):
-        # TODO put in a bundle shared between mapnik and mapserver with common data.
-        self.fetch_resources([
-            ("http://tile.openstreetmap.org/world_boundaries-spherical.tgz",
-                "data", "4feb2f60a37bbe4e8a33596befcd0a1c"),
-            ("http://tile.openstreetmap.org/processed_p.tar.bz2",
-                "data/world_boundaries"),
-            ("http://tile.openstreetmap.org/shoreline_300.tar.bz2",
-                "data/world_boundaries"),
-            ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/download/10m/cultural/10m-populated-places.zip",
-                "data/world_boundaries", "ba61ef461732bbd85fea18deafb6db8c"),
-            ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/download/110m/cultural/110m-admin-0-boundary-lines.zip",
-                "data/world_boundaries", "1d116cde1491e514f3f49224682f82b5"),
-        ])
+        self.fetch_resources(self.DATA_RESOURCES)
 
     def build(self):
         cmd = [
@@ -936,6 +2676,8 @@ class MapnikOGCServer(Bundle):
 
 class MapserverBuild(Bundle):
     MS_VERSION = "6.0.0"
+    RESOURCE = ("http://download.osgeo.org/mapserver/mapserver-%s.tar.gz" %
+        MS_VERSION, "build", "5bcb1a6fb4a743e9f069466fbdf4ab76")
 
     def __init__(self, *args, **kwargs):
         super(MapserverBuild, self).__init__(*args, **kwargs)
@@ -950,11 +2692,15 @@ class MapserverBuild(Bundle):
         self.install_packages([line.split()[1] for line in lines])
 
     def download(self):
-        self.fetch_resources([
-            ("http://download.osgeo.org/mapserver/mapserver-%s.tar.gz" % self.MS_VERSION,
-                "build", "5bcb1a6fb4a743e9f069466fbdf4ab76"),
-        ])
+        self.fetch_resources([self.RESOURCE])
+
+    def _get_source_archive(self):
+        return [self.executor.fetcher.get_downloaded_path(self.RESOURCE)]
 
+    def _clean_executable(self):
+        maybe_unlink(join(self.ms_dir, "mapserv"))
+
+    @cached_step(files="_get_source_archive", clean="_clean_executable")
     def build(self):
         if os.path.isfile(join(self.ms_dir, "mapserv")):
             log.debug("Executable already built")
@@ -1042,43 +2788,31 @@ class MapserverConfig(Bundle, SVNCheckoutMixin):
     def system_setup(self):
         self.install_packages("cpp make patch")
 
-    def download(self):
-        self.fetch_resources([
-            ("http://thematicmapping.org/downloads/TM_WORLD_BORDERS-0.3.zip",
-                None, "7ac5c67b43e1dc9233cdb48bdf018a6c"),
-            ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/"
-                "download/10m/cultural/10m-admin-0-boundary-lines-land.zip",
-                None, "f3dc23b8d3ede755d56b50f2ca7d0612"),
-        ])
-
-        # Try to reuse previously downloaded archives by creating hard links
-        # into mapserver-utils/data so that they won't be downloaded again.
-        DATA_ARCHIVES = [
-            "processed_p.tar.bz2",
-            "world_boundaries-spherical.tgz",
-            "10m-populated-places.zip",
-            "10m-admin-0-boundary-lines-land.zip",
-            "110m-admin-0-boundary-lines.zip",
-            "shoreline_300.tar.bz2",
-            "TM_WORLD_BORDERS-0.3.zip",
-        ]
-        for archive in DATA_ARCHIVES:
-            downloaded_archive = join(
-                self.project_dir, "data", "download_cache", archive)
-            if not os.path.isfile(downloaded_archive):
-                continue
-            link_source = join(self.ms_utils_dir, "data", archive)
-            if os.path.isfile(link_source):
-                continue
-            print downloaded_archive, link_source
-            os.link(downloaded_archive, link_source)
+    DATA_RESOURCES = [
+        ("http://thematicmapping.org/downloads/TM_WORLD_BORDERS-0.3.zip",
+            None, "7ac5c67b43e1dc9233cdb48bdf018a6c"),
+        ("http://www.naturalearthdata.com/http//www.naturalearthdata.com/"
+            "download/10m/cultural/10m-admin-0-boundary-lines-land.zip",
+            None, "f3dc23b8d3ede755d56b50f2ca7d0612"),
+    ]
 
-        try:
-            call("cp -rl data/world_boundaries/* mapserver-utils/data/",
-                shell=True, cwd=self.project_dir,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            pass
+    def download(self):
+        fetcher = self.executor.fetcher
+        # mapserver-utils also needs the Mapnik data. It is downloaded only
+        # once thanks to the download cache.
+        shared_resources = [(r[0], None) + tuple(r[2:]) for r in
+            MapnikConfig.DATA_RESOURCES]
+        self.fetch_resources(self.DATA_RESOURCES + shared_resources)
+
+        # Link the archives into mapserver-utils/data so that they won't be
+        # downloaded again, and their extracted content so that they won't be
+        # extracted again.
+        data_dir = join("mapserver-utils", "data")
+        for resource in self.DATA_RESOURCES + shared_resources:
+            fetcher.link_downloaded(resource, data_dir)
+        for resource in MapnikConfig.DATA_RESOURCES:
+            fetcher.materialize(resource, data_dir, os.path.relpath(
+                MapnikConfig.WORLD_BOUNDARIES_DIR, resource[1]))
 
         call("touch mapserver-utils/data/*shp", shell=True, cwd=self.project_dir)
 
@@ -1107,17 +2841,104 @@ class MapserverConfig(Bundle, SVNCheckoutMixin):
             cwd=self.ms_utils_dir)
 
 
+class SeedProgress(object):
+    """Tiles seeded per layer, logged with the rate and the estimated
+    remaining time at most every LOG_INTERVAL seconds."""
+
+    LOG_INTERVAL = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.last_log = self.start
+        self.layers = []
+        self.seeded = {}
+        self.remaining = {}
+        # Tiles seeded by this run.
+        self.done = {}
+
+    def add_layer(self, layer):
+        if layer not in self.layers:
+            self.layers.append(layer)
+            self.seeded[layer] = self.remaining[layer] = self.done[layer] = 0
+
+    def add_seeded(self, layer, tiles):
+        self.seeded[layer] += tiles
+
+    def add_remaining(self, layer, tiles):
+        self.remaining[layer] += tiles
+
+    def add(self, layer, tiles):
+        with self.lock:
+            self.done[layer] += tiles
+            self.seeded[layer] += tiles
+            self.remaining[layer] -= tiles
+            if time.time() - self.last_log >= self.LOG_INTERVAL:
+                self.log()
+
+    def log(self):
+        self.last_log = time.time()
+        elapsed = max(self.last_log - self.start, 0.001)
+        for layer in self.layers:
+            rate = self.done[layer] / elapsed
+            if not self.remaining[layer]:
+                eta = "done"
+            elif rate:
+                eta = "ETA {0}".format(datetime.timedelta(
+                    seconds=int(self.remaining[layer] / rate)))
+            else:
+                eta = "ETA unknown"
+            log.info("Seeding %s: %d tiles seeded, %d remaining, %.1f tiles/s, "
+                "%s", layer, self.seeded[layer], self.remaining[layer], rate,
+                eta)
+
+
 class TileCache(Bundle):
     # Group under which TileCache will be run. The cache directory will be
     # made writable and group sgid to that group, so that both Apache and
     # the user running this script can both write tile images.
     TILECACHE_GROUP = "www-data"
     TILECACHE_VERSION = "2.11"
+    # Layers use the spherical mercator grid, starting at -WORLD_EXTENT.
+    WORLD_EXTENT = 20037508.342789244
+    # Default of TileCache when metaSize isn't set.
+    DEFAULT_META_SIZE = (5, 5)
+    # Tables rendered by the layers, by layer name prefix.
+    LAYER_TABLES_PREFIX = {
+        "mapnik": "osm_mapnik",
+        "mapserver": "osm_mapserver",
+    }
+    # Areas seeded by generate, so that an interrupted run can be resumed,
+    # and the import of the tables they were rendered from.
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS seeded (
+            layer TEXT NOT NULL,
+            zoom INTEGER NOT NULL,
+            bbox TEXT NOT NULL,
+            tiles INTEGER NOT NULL,
+            seeded_at REAL NOT NULL,
+            PRIMARY KEY (layer, zoom, bbox))""",
+        """CREATE TABLE IF NOT EXISTS seeded_data (
+            layer TEXT PRIMARY KEY,
+            token TEXT)""",
+    ]
 
     def __init__(self, *args, **kwargs):
         super(TileCache, self).__init__(*args, **kwargs)
         self.tc_dir = join(self.project_dir, "build", "tilecache")
         self.cache_dir = join(self.project_dir, "data", "tiles", "tc_cache")
+        self.tc_config = join(self.project_dir, "tilecache", "tilecache.cfg")
+        self.logs_dir = join(self.project_dir, "data", "logs", "seed")
+        self.metadata = self.executor.metadata
+        self.metadata.create_tables(self.SCHEMA)
+
+    @property
+    def run_after(self):
+        # Seeding needs the configurations of the layers.
+        names = ["mapnikconfig_" + n for n in self.config.MAPNIK_INSTANCES]
+        if self.config.USE_MAPSERVER:
+            names.append("mapserverconfig")
+        return names
 
     def system_setup(self):
         self.install_packages("python-imaging")
@@ -1153,7 +2974,7 @@ class TileCache(Bundle):
         os.rename(old_dir, self.tc_dir)
 
     def build(self):
-        tc_config = join(self.project_dir, "tilecache", "tilecache.cfg")
+        tc_config = self.tc_config
         content = open(tc_config).read()
         # TODO: use tempita for instead
         if "@@MAPNIK_START@@" not in content:
@@ -1172,35 +2993,227 @@ class TileCache(Bundle):
         result += after
         open(tc_config, "wb").write(result)
 
-    def generate(self):
-        seed_script = join(self.tc_dir, "tilecache_seed.py")
-        tc_config = join(self.project_dir, "tilecache", "tilecache.cfg")
-
+    def _get_layers(self):
         layers = []
         for name in self.config.MAPNIK_INSTANCES:
             layers.append("mapnik_" + name)
         if self.config.USE_MAPSERVER:
             layers.append("mapserver")
-        bbox = ",".join(str(c) for c in self.config.EXTENT_OSM)
-
+        return layers
+
+    def _read_config(self):
+        parser = ConfigParser.RawConfigParser()
+        parser.read(self.tc_config)
+        return parser
+
+    def _get_meta_size(self, parser, layer):
+        # ConfigParser lowercases the option names (like TileCache).
+        if parser.has_option(layer, "metasize"):
+            return tuple(int(s) for s in
+                parser.get(layer, "metasize").split(","))
+        return self.DEFAULT_META_SIZE
+
+    def _get_tile_path(self, parser, layer, zoom, x, y):
+        """Path of a tile in the Disk cache of TileCache (y counted from the
+        bottom)."""
+        extension = "png"
+        if parser.has_option(layer, "extension"):
+            extension = parser.get(layer, "extension").lower()
+        if extension == "jpg":
+            extension = "jpeg"
+        base_dir = self.cache_dir
+        if parser.has_option("cache", "base"):
+            base_dir = parser.get("cache", "base")
+        return join(base_dir, layer, "%02d" % zoom,
+            "%03d" % (x / 1000000), "%03d" % (x / 1000 % 1000),
+            "%03d" % (x % 1000), "%03d" % (y / 1000000),
+            "%03d" % (y / 1000 % 1000), "%03d.%s" % (y % 1000, extension))
+
+    def _get_cell_bbox(self, zoom, x, y, size):
+        """Bounding box to seed the size[0] x size[1] tiles starting at x, y
+        (see _get_seed_units)."""
+        tile_span = 2 * self.WORLD_EXTENT / 2 ** zoom
+        # Metatiles can be larger than the world at low zoom levels.
+        last = 2 ** zoom - 1
+        return tuple((c + 0.25) * tile_span - self.WORLD_EXTENT for c in
+            (x, y, min(x + size[0] - 1, last), min(y + size[1] - 1, last)))
+
+    def _get_seed_units(self, zoom, meta_size):
+        """Splits EXTENT_OSM into the bounding boxes of the areas seeded by
+        one process at the given zoom level.
+
+        Areas are SEED_UNIT_METATILES x SEED_UNIT_METATILES metatiles, aligned
+        on metatiles so that processes don't render the same metatiles.
+        """
+        minx, miny, maxx, maxy = self.config.EXTENT_OSM
+        origin = self.WORLD_EXTENT
+        tile_span = 2 * origin / 2 ** zoom
+        unit_size = [m * self.config.SEED_UNIT_METATILES for m in meta_size]
+
+        def get_units(low, high, size):
+            first = int((low + origin) / tile_span)
+            last = int((high + origin) / tile_span)
+            units = []
+            for start in range(first // size * size, last + 1, size):
+                low_cell = max(start, first)
+                high_cell = min(start + size - 1, last)
+                # The seeder rounds the corners to the closest tiles, so the
+                # bounds are moved inside the first and last tiles.
+                units.append(((low_cell + 0.25) * tile_span - origin,
+                    (high_cell + 0.25) * tile_span - origin,
+                    high_cell - low_cell + 1))
+            return units
+
+        units = []
+        for unit_miny, unit_maxy, rows in get_units(miny, maxy, unit_size[1]):
+            for unit_minx, unit_maxx, cols in get_units(
+                minx, maxx, unit_size[0]):
+                units.append(((unit_minx, unit_miny, unit_maxx, unit_maxy),
+                    rows * cols))
+        return units
+
+    def _call_seeder(self, layer, zoom, bbox):
+        # The seeder prints a line per metatile, which goes to a log file.
+        with open(join(self.logs_dir, "{0}.log".format(layer)), "ab") as f:
+            call([join(self.tc_dir, "tilecache_seed.py"), "-c", self.tc_config,
+                "-b", bbox, layer, str(zoom), str(zoom + 1)],
+                stdout=f, stderr=subprocess.STDOUT)
+
+    def _seed_unit(self, layer, zoom, bbox, tiles, progress):
+        bbox = ",".join(repr(c) for c in bbox)
+        self._call_seeder(layer, zoom, bbox)
+        self.metadata.execute("INSERT OR REPLACE INTO seeded VALUES "
+            "(?, ?, ?, ?, ?)", layer, zoom, bbox, tiles, time.time())
+        progress.add(layer, tiles)
+
+    def _get_data_token(self, layer):
+        """Returns the token of the last import of the tables rendered by
+        layer (see StepCache)."""
+        tables_prefix = self.LAYER_TABLES_PREFIX.get(layer.split("_")[0])
+        if not tables_prefix:
+            return None
+        return self.metadata.query_value(
+            "SELECT token FROM steps WHERE name = ?",
+            "osmdata_{0}._load_data".format(tables_prefix))
+
+    def _forget_stale_seeded(self, layers):
+        """Forgets the areas seeded from data which was imported again."""
         for layer in layers:
+            token = self._get_data_token(layer)
+            row = self.metadata.query_row(
+                "SELECT token FROM seeded_data WHERE layer = ?", layer)
+            if row is None or row[0] != token:
+                self.metadata.execute(
+                    "DELETE FROM seeded WHERE layer = ?", layer)
+                self.metadata.execute(
+                    "INSERT OR REPLACE INTO seeded_data VALUES (?, ?)",
+                    layer, token)
+
+    def generate(self):
+        parser = self._read_config()
+
+        units = []
+        for layer in self._get_layers():
             if layer in self.config.TILECACHE_NOSEED_LAYERS:
                 continue
-            log.info("Seeding layer: %s", layer)
             zooms = ((self.config.SEED_ZOOM_FROM, self.config.SEED_ZOOM_TO),)
             if layer in self.config.SEED_ZOOMS:
                 zooms = self.config.SEED_ZOOMS[layer]
-            
+
+            meta_size = self._get_meta_size(parser, layer)
             for start_zoom, end_zoom in zooms:
-                # XXX add padding too? (-p option).
-                call([seed_script, "-c", tc_config, "-b", bbox, layer,
-                    str(start_zoom),
-                    str(end_zoom + 1)])
+                for zoom in range(start_zoom, end_zoom + 1):
+                    # XXX add padding too? (-p option).
+                    units.extend((zoom, layer, bbox, tiles) for
+                        (bbox, tiles) in self._get_seed_units(zoom, meta_size))
+
+        # Areas seeded by a previous run which was interrupted.
+        self._forget_stale_seeded(set(unit[1] for unit in units))
+        seeded = set(self.metadata.query("SELECT layer, zoom, bbox FROM seeded"))
+        progress = SeedProgress()
+        remaining = []
+        for zoom, layer, bbox, tiles in units:
+            progress.add_layer(layer)
+            if (layer, zoom, ",".join(repr(c) for c in bbox)) in seeded:
+                progress.add_seeded(layer, tiles)
+            else:
+                progress.add_remaining(layer, tiles)
+                remaining.append((zoom, layer, bbox, tiles))
+        if len(remaining) < len(units):
+            log.info("Resuming seeding, %d of %d areas were already seeded",
+                len(units) - len(remaining), len(units))
+
+        if not os.path.isdir(self.logs_dir):
+            make_dirs_as_project_owner(self.project_dir, self.logs_dir)
+        # All the layers are seeded at the same time, lower zoom levels first.
+        remaining.sort(key=lambda unit: unit[0])
+        jobs = self.config.SEED_JOBS or multiprocessing.cpu_count()
+        log.info("Seeding %d areas with %d processes (output in %s)",
+            len(remaining), jobs, self.logs_dir)
+        pool = WorkerPool(jobs, "seed")
+        for zoom, layer, bbox, tiles in remaining:
+            pool.submit(self._seed_unit, layer, zoom, bbox, tiles, progress)
+        pool.join()
+        progress.log()
+        # Only interrupted runs are resumed, the next one seeds everything.
+        self.metadata.execute("DELETE FROM seeded")
 
     def generate_clean(self):
         for d in os.listdir(self.cache_dir):
             # not using maybe_unlink to report errors.
             shutil.rmtree(join(self.cache_dir, d))
+        self.metadata.execute("DELETE FROM seeded")
+        self.metadata.execute("DELETE FROM seeded_data")
+
+    def expire(self, tables_prefix, expired_path):
+        """Deletes the tiles listed in an expiry file of osm2pgsql from the
+        layers rendering the given tables.
+
+        Tiles are deleted from the lowest zoom level, and the ones up to
+        EXPIRE_RESEED_ZOOM_TO are seeded again.
+        """
+        layers = [l for l in self._get_layers() if
+            self.LAYER_TABLES_PREFIX.get(l.split("_")[0]) == tables_prefix]
+        expired = set()
+        for line in open(expired_path):
+            if line.strip():
+                zoom, x, y = [int(c) for c in line.split("/")]
+                # osm2pgsql counts y from the top, TileCache from the bottom.
+                expired.add((zoom, x, 2 ** zoom - 1 - y))
+        expired = sorted(expired)
+        log.info("Expiring %d tiles of layers %s", len(expired),
+            ", ".join(layers))
+
+        parser = self._read_config()
+        reseed = set()
+        deleted = 0
+        for layer in layers:
+            meta_size = self._get_meta_size(parser, layer)
+            for zoom, x, y in expired:
+                try:
+                    os.unlink(self._get_tile_path(parser, layer, zoom, x, y))
+                    deleted += 1
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                if (layer not in self.config.TILECACHE_NOSEED_LAYERS and
+                    zoom <= self.config.EXPIRE_RESEED_ZOOM_TO):
+                    reseed.add((zoom, layer, x - x % meta_size[0],
+                        y - y % meta_size[1], meta_size))
+        log.info("Deleted %d cached tiles", deleted)
+        if not reseed:
+            return
+
+        if not os.path.isdir(self.logs_dir):
+            make_dirs_as_project_owner(self.project_dir, self.logs_dir)
+        jobs = self.config.SEED_JOBS or multiprocessing.cpu_count()
+        log.info("Seeding %d metatiles again with %d processes", len(reseed),
+            jobs)
+        pool = WorkerPool(jobs, "seed")
+        for zoom, layer, x, y, meta_size in sorted(reseed):
+            pool.submit(self._call_seeder, layer, zoom, ",".join(repr(c) for c
+                in self._get_cell_bbox(zoom, x, y, meta_size)))
+        pool.join()
 
 
 class ApacheConfig(Bundle):
@@ -1233,15 +3246,20 @@ class OpenLayers(Bundle):
 
 
 class BundleExecutor(object):
-    def __init__(self, options):
+    def __init__(self, options, project_dir=None):
         self.oss_dir = os.path.abspath(os.path.dirname(__file__))
-        self.project_dir = os.path.normpath(
+        self.project_dir = project_dir or os.path.normpath(
             join(self.oss_dir, os.pardir))
         self.build_dir = join(self.project_dir, "build")
         make_dirs_as_project_owner(self.project_dir, self.build_dir)
 
         self.options = options
         self.config = self._parse_config()
+        data_dir = join(self.project_dir, "data")
+        make_dirs_as_project_owner(self.project_dir, data_dir)
+        self.metadata = MetadataStore(
+            self.project_dir, join(data_dir, "metadata.sqlite"))
+        self.steps = StepCache(self)
         self.fetcher = Fetcher(self)
 
     def _parse_config(self):
@@ -1261,11 +3279,7 @@ class BundleExecutor(object):
         log.debug("config: %s", config)
 
         # Convert the dict to an object, which is a bit more convenient to handle.
-        class Struct:
-            def __init__(self, d):
-                self.__dict__.update(d)
-
-        config = Struct(config)
+        config = Config(config)
 
         # Helper values
 
@@ -1283,20 +3297,22 @@ class BundleExecutor(object):
         bundles = [b for b in self.bundles if b.name == name]
         if len(bundles) != 1:
             raise Exception(
-                "Not only one bundle found for name {1} (found: {1})".
-                format(class_.__name__, len(bundles)))
+                "Not only one bundle found for name {0} (found: {1})".
+                format(name, len(bundles)))
         return bundles[0]
 
+    def _instanciate_bundle(self, bundle_class_or_tuple):
+        bundle_class = bundle_class_or_tuple
+        args = [self]
+        if isinstance(bundle_class_or_tuple, tuple):
+            bundle_class = bundle_class_or_tuple[0]
+            args.extend(bundle_class_or_tuple[1:])
+        return bundle_class(*args)
+
     def _create_bundles(self, bundle_name_to_only_load):
         self.bundles = []
 
-        def instanciate_bundle(bundle_class_or_tuple):
-            bundle_class = bundle_class_or_tuple
-            args = [self]
-            if isinstance(bundle_class_or_tuple, tuple):
-                bundle_class = bundle_class_or_tuple[0]
-                args.extend(bundle_class_or_tuple[1:])
-            return bundle_class(*args)
+        instanciate_bundle = self._instanciate_bundle
 
         bundles_to_load = []
 
@@ -1367,12 +3383,140 @@ class BundleExecutor(object):
             raise Exception("commands {0} must be run with root user".format(
                 " or ".join(ROOT_COMMANDS)))
 
+        self.report = RunReport(command)
+        try:
+            if self.options.jobs > 1 and command not in ROOT_COMMANDS:
+                self._execute_parallel(command, self.options.jobs)
+            else:
+                for bundle in self.bundles:
+                    if not hasattr(bundle, command):
+                        continue
+                    self._call_bundle_command(bundle, command)
+        finally:
+            self._write_report()
+
+    def _write_report(self):
+        """Write the run report to data/reports/ and log its summary."""
+        reports_dir = join(self.project_dir, "data", "reports")
+        make_dirs_as_project_owner(self.project_dir, reports_dir)
+        report_path = join(reports_dir, "{0}-{1}.json".format(
+            time.strftime("%Y%m%d-%H%M%S"), self.report.command))
+        self.report.write(report_path)
+        self.report.log_summary()
+        log.info("Run report written to %s", report_path)
+
+    def _call_bundle_command(self, bundle, command):
+        step_context.command = command
+        try:
+            with self.report.measure(bundle, command):
+                getattr(bundle, command)()
+        finally:
+            step_context.command = None
+        if command.endswith("_clean"):
+            self.steps.forget(bundle.name, command[:-len("_clean")])
+
+    def _get_bundle_graph(self):
+        """Return a dictionary mapping each bundle name to the names of the
+        bundles that must run before it."""
+        names = set(b.name for b in self.bundles)
+        core_name = self.bundles[0].name
+        graph = {}
         for bundle in self.bundles:
+            before = set(self._instanciate_bundle(c).name for c in
+                bundle.dependencies)
+            before.update(bundle.run_after)
+            # The core bundle generates files used by all the others.
+            before.add(core_name)
+            before.discard(bundle.name)
+            graph[bundle.name] = before & names
+        return graph
+
+    def _run_bundle_command(self, bundle, command, log_dir):
+        handler = logging.FileHandler(join(log_dir, bundle.name + ".log"), "w")
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(message)s"))
+        handler.addFilter(ThreadLogFilter(threading.current_thread().name))
+        logging.getLogger().addHandler(handler)
+        call_output.file = handler.stream
+        try:
+            self._call_bundle_command(bundle, command)
+        finally:
+            call_output.file = None
+            logging.getLogger().removeHandler(handler)
+            handler.close()
+
+    def _execute_parallel(self, command, jobs):
+        """Run the command on up to jobs bundles at the same time, each
+        bundle starting once the bundles it depends on are done.
+
+        Output of each bundle is written to data/logs/COMMAND/BUNDLE.log.
+        After a failure, no new bundle is started and the error is raised
+        once the running bundles are finished.
+        """
+        log_dir = join(self.project_dir, "data", "logs", command)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+        graph = self._get_bundle_graph()
+        waiting = [b for b in self.bundles]
+        done = set()
+        running = set()
+        errors = []
+        condition = threading.Condition()
+
+        def run(bundle):
+            error = None
             try:
-                method = getattr(bundle, command)
-            except AttributeError:
-                continue
-            method()
+                self._run_bundle_command(bundle, command, log_dir)
+            except Exception:
+                error = sys.exc_info()
+                log.error("Bundle %s failed, see %s", bundle.name,
+                    join(log_dir, bundle.name + ".log"), exc_info=True)
+            with condition:
+                running.discard(bundle.name)
+                if error:
+                    errors.append(error)
+                else:
+                    done.add(bundle.name)
+                    log.info("Bundle %s done", bundle.name)
+                condition.notify_all()
+
+        def start_ready_bundles():
+            started = False
+            for bundle in list(waiting):
+                if len(running) >= jobs:
+                    break
+                if not graph[bundle.name] <= done:
+                    continue
+                waiting.remove(bundle)
+                started = True
+                if not hasattr(bundle, command):
+                    done.add(bundle.name)
+                    continue
+                log.info("Starting bundle %s", bundle.name)
+                running.add(bundle.name)
+                t = threading.Thread(
+                    target=run, args=(bundle,), name=bundle.name)
+                t.daemon = True
+                t.start()
+            return started
+
+        with condition:
+            while waiting or running:
+                if not errors:
+                    while start_ready_bundles():
+                        pass
+                    if waiting and not running:
+                        # Can't happen unless dependencies are inconsistent.
+                        raise Exception("Bundles can't be scheduled: %s" %
+                            waiting)
+                elif not running:
+                    break
+                # Waiting with a timeout keeps the main thread interruptible.
+                condition.wait(0.5)
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
 
 if __name__ == "__main__":
@@ -1387,6 +3531,12 @@ if __name__ == "__main__":
          default=False, help="Overwrite existing files without confirmation during project creation.")
     parser.add_option("-v", "--verbose", action="store_true",
          default=False, help="Print debug logging")
+    parser.add_option("--force", action="store_true",
+         default=False, help="Run the steps again even if their inputs "
+         "didn't change since their last run.")
+    parser.add_option("-j", "--jobs", type="int", default=1,
+         help="Number of bundles to run in parallel (default: %default). "
+         "Output of each bundle is written to data/logs/COMMAND/BUNDLE.log.")
 
     (options, args) = parser.parse_args()
 
@@ -1394,8 +3544,11 @@ if __name__ == "__main__":
         parser.print_help()
         sys.exit(1)
 
+    log_format = logging.BASIC_FORMAT
+    if options.jobs > 1:
+        log_format = "%(threadName)s:" + log_format
     logging.basicConfig(level=(logging.DEBUG if options.verbose else
-                               logging.INFO))
+                               logging.INFO), format=log_format)
 
     command = args[0]
     bundle = None
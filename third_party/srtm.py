@@ -16,11 +16,21 @@ import os
 import zipfile
 import array
 import math
+import mmap
+import struct
+import sys
+import time
+import threading
+import Queue
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class NoSuchTileError(Exception):
     """Raised when there is no tile for a region."""
     def __init__(self, lat, lon):
-        Exception.__init__()
+        Exception.__init__(self)
         self.lat = lat
         self.lon = lon
 
@@ -31,7 +41,7 @@ class NoSuchTileError(Exception):
 class WrongTileError(Exception):
     """Raised when the value of a pixel outside the tile area is requested."""
     def __init__(self, tile_lat, tile_lon, req_lat, req_lon):
-        Exception.__init__()
+        Exception.__init__(self)
         self.tile_lat = tile_lat
         self.tile_lon = tile_lon
         self.req_lat = req_lat
@@ -44,19 +54,33 @@ class WrongTileError(Exception):
 class InvalidTileError(Exception):
     """Raised when the SRTM tile file contains invalid data."""
     def __init__(self, lat, lon):
-        Exception.__init__()
+        Exception.__init__(self)
         self.lat = lat
         self.lon = lon
 
     def __str__(self):
         return "SRTM tile for %d, %d is invalid!" % (self.lat, self.lon)
 
+class TileDownloadError(Exception):
+    """Raised when the server refuses a tile, which retrying won't fix."""
+    def __init__(self, filename, reason):
+        Exception.__init__(self)
+        self.filename = filename
+        self.reason = reason
+
+    def __str__(self):
+        return "Error downloading %s: %s" % (self.filename, self.reason)
+
 class SRTMDownloader:
     """Automatically download SRTM tiles."""
+    # Size of the blocks written to the cache while a tile is downloaded.
+    CHUNK_SIZE = 64 * 1024
+
     def __init__(self, server="dds.cr.usgs.gov",
                  directory="/srtm/version2_1/SRTM3/",
                  cachedir="cache",
-                 protocol="http"):
+                 protocol="http",
+                 tile_cache_size=256 * 1024 * 1024):
         self.protocol=protocol
         self.server = server
         self.directory = directory
@@ -69,8 +93,13 @@ class SRTMDownloader:
         self.filename_regex = re.compile(
                 r"([NS])(\d{2})([EW])(\d{3})\.hgt\.zip")
         self.filelist_file = self.cachedir + "/filelist_python"
-        self.ftpfile = None
-        self.ftp_bytes_transfered = 0
+        # Tiles returned by getTile, kept while their data fits in
+        # tile_cache_size bytes. tiles_order lists the least recently used
+        # first.
+        self.tile_cache_size = tile_cache_size
+        self.tiles = {}
+        self.tiles_order = []
+        self.tiles_lock = threading.Lock()
 
     def loadFileList(self):
         """Load a previously created file list or create a new one if none is
@@ -185,57 +214,198 @@ class SRTMDownloader:
             continent, filename = self.filelist[(int(lat), int(lon))]
         except KeyError:
             raise NoSuchTileError(lat, lon)
+        key = (int(lat), int(lon))
+        with self.tiles_lock:
+            tile = self.tiles.get(key)
+            if tile is not None:
+                self.tiles_order.remove(key)
+                self.tiles_order.append(key)
+                return tile
         if not os.path.exists(self.cachedir + "/" + filename):
             self.downloadTile(continent, filename)
-        # TODO: Currently we create a new tile object each time.
-        # Caching is required for improved performance.
-        return SRTMTile(self.cachedir + "/" + filename, int(lat), int(lon))
+        tile = SRTMTile(self.cachedir + "/" + filename, key[0], key[1])
+        with self.tiles_lock:
+            if key not in self.tiles:
+                self.tiles[key] = tile
+                self.tiles_order.append(key)
+            self._evictTiles()
+            return self.tiles[key]
+
+    def getAltitudes(self, lats, lons):
+        """Get the altitudes of many points at once, lats and lons being
+            sequences (or arrays of any shape) of the same length. The points
+            are grouped by tile and interpolated like getAltitudeFromLatLon
+            with numpy, points without data get NaN. Without numpy, returns
+            the list of getAltitudeFromLatLon values instead."""
+        if numpy is None:
+            return [self.getTile(math.floor(lat), math.floor(lon)).
+                getAltitudeFromLatLon(lat, lon) for lat, lon in zip(lats, lons)]
+        lats = numpy.asarray(lats, dtype=numpy.float64)
+        lons = numpy.asarray(lons, dtype=numpy.float64)
+        shape = lats.shape
+        lats = lats.ravel()
+        lons = lons.ravel()
+        result = numpy.empty(len(lats))
+        tile_lats = numpy.floor(lats).astype(int)
+        tile_lons = numpy.floor(lons).astype(int)
+        # Sort the points by tile and split them where the tile changes.
+        keys = (tile_lats + 90) * 361 + (tile_lons + 180)
+        order = numpy.argsort(keys, kind="mergesort")
+        bounds = numpy.flatnonzero(numpy.diff(keys[order])) + 1
+        for indexes in numpy.split(order, bounds):
+            if not len(indexes):
+                continue
+            tile = self.getTile(tile_lats[indexes[0]], tile_lons[indexes[0]])
+            result[indexes] = tile.getAltitudes(lats[indexes], lons[indexes])
+        return result.reshape(shape)
+
+    def _evictTiles(self):
+        """Forget the least recently used tiles until the cached tiles fit in
+            the budget. The data of a tile is unmapped once the tile is not
+            used anymore."""
+        total = sum(t.getDataSize() for t in self.tiles.values())
+        while total > self.tile_cache_size and len(self.tiles_order) > 1:
+            key = self.tiles_order.pop(0)
+            total -= self.tiles.pop(key).getDataSize()
 
     def downloadTile(self, continent, filename):
         """Download a tile from NASA's server and store it in the cache."""
-        if self.protocol=="ftp":
-            ftp = ftplib.FTP(self.server)
+        conn = self._connect()
+        try:
+            self._fetchTile(conn, continent, filename)
+        finally:
+            conn.close()
+
+    def downloadTiles(self, coordinates, jobs=4, retries=3):
+        """Download the tiles of the given (lat, lon) pairs which are not in
+            the cache yet, over jobs connections at the same time. Each
+            connection is kept open and reused for the following tiles."""
+        tasks = Queue.Queue()
+        for lat, lon in coordinates:
             try:
-                ftp.login()
-                ftp.cwd(self.directory+"/"+continent)
-                # WARNING: This is not thread safe
-                self.ftpfile = open(self.cachedir + "/" + filename, 'wb')
-                self.ftp_bytes_transfered = 0
-                print ""
-                try:
-                    ftp.retrbinary("RETR "+filename, self.ftpCallback)
-                finally:
-                    self.ftpfile.close()
-                    self.ftpfile = None
+                continent, filename = self.filelist[(int(lat), int(lon))]
+            except KeyError:
+                raise NoSuchTileError(lat, lon)
+            if not os.path.exists(self.cachedir + "/" + filename):
+                tasks.put((continent, filename))
+        errors = []
+
+        def worker():
+            conn = None
+            try:
+                while not errors:
+                    try:
+                        continent, filename = tasks.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        conn = self._fetchTileWithRetries(conn, continent,
+                            filename, retries)
+                    except Exception:
+                        errors.append(sys.exc_info())
             finally:
-                ftp.close()
-        else:
-            #Use HTTP
-            conn = httplib.HTTPConnection(self.server)
-            conn.set_debuglevel(0)
-            filepath = "%s%s%s" % \
-                         (self.directory,continent,filename)
-            print "filepath=%s" % filepath
-            conn.request("GET", filepath)
-            r1 = conn.getresponse()
-            if r1.status==200:
-                print "status200 received ok"
-                data = r1.read()
-                self.ftpfile = open(self.cachedir + "/" + filename, 'wb')
-                self.ftpfile.write(data)
-                self.ftpfile.close()
-                self.ftpfile = None
+                if conn is not None:
+                    conn.close()
+
+        threads = []
+        for i in range(max(1, min(jobs, tasks.qsize()))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            # Joining with a timeout keeps the main thread interruptible.
+            while t.isAlive():
+                t.join(0.5)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    def _fetchTileWithRetries(self, conn, continent, filename, retries):
+        """Download a tile over conn, reconnecting after failures. Returns
+            the connection to use for the next tile."""
+        for attempt in range(retries + 1):
+            try:
+                if conn is None:
+                    conn = self._connect()
+                self._fetchTile(conn, continent, filename)
+                return conn
+            except (IOError, EOFError, httplib.HTTPException,
+                    ftplib.Error), e:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                if isinstance(e, ftplib.error_perm):
+                    # Such as a missing file, which retrying won't fix.
+                    raise TileDownloadError(filename, e)
+                if attempt == retries:
+                    raise
+                print "Error downloading %s (%s), retrying" % (filename, e)
+                time.sleep(2 ** attempt)
+
+    def _connect(self):
+        """Open a connection to the server, logged into it for ftp."""
+        if self.protocol == "ftp":
+            ftp = ftplib.FTP(self.server, timeout=60)
+            ftp.login()
+            return ftp
+        return httplib.HTTPConnection(self.server, timeout=60)
+
+    def _fetchTile(self, conn, continent, filename):
+        """Download a tile over an open connection. The data is written to a
+            .part file renamed once complete, so that an interrupted download
+            is never taken for a cached tile."""
+        path = self.cachedir + "/" + filename
+        part_path = "%s.part.%d" % (path, threading.current_thread().ident)
+        output = open(part_path, 'wb')
+        try:
+            if self.protocol == "ftp":
+                conn.cwd(self.directory + "/" + continent)
+                conn.retrbinary("RETR " + filename, output.write,
+                    self.CHUNK_SIZE)
             else:
-                print "oh no = status=%d %s" \
-                      % (r1.status,r1.reason)
-
-
-
-    def ftpCallback(self, data):
-        """Called by ftplib when some bytes have been received."""
-        self.ftpfile.write(data)
-        self.ftp_bytes_transfered += len(data)
-        print "\r%d bytes transfered" % self.ftp_bytes_transfered,
+                conn.request("GET", "%s%s%s" %
+                    (self.directory, continent, filename))
+                r1 = conn.getresponse()
+                if 400 <= r1.status < 500:
+                    r1.read()
+                    raise TileDownloadError(filename,
+                        "status=%d %s" % (r1.status, r1.reason))
+                if r1.status != 200:
+                    r1.read()
+                    raise IOError("Error downloading %s: status=%d %s" %
+                        (filename, r1.status, r1.reason))
+                # Read the response to the end, which lets the connection be
+                # reused for the next request.
+                size = 0
+                for data in iter(lambda: r1.read(self.CHUNK_SIZE), ""):
+                    output.write(data)
+                    size += len(data)
+                length = r1.getheader("content-length")
+                if length is not None and size != int(length):
+                    raise IOError("Error downloading %s: got %d of %s bytes" %
+                        (filename, size, length))
+            output.close()
+            self._checkTile(part_path, filename)
+            os.rename(part_path, path)
+        finally:
+            output.close()
+            if os.path.exists(part_path):
+                os.unlink(part_path)
+
+    def _checkTile(self, path, filename):
+        """Raise IOError unless path is a zip of SRTM1/3 samples, so that a
+            corrupted download is retried rather than cached."""
+        try:
+            zipf = zipfile.ZipFile(path, 'r')
+            try:
+                infos = zipf.infolist()
+            finally:
+                zipf.close()
+        except zipfile.BadZipfile, e:
+            raise IOError("Error downloading %s: %s" % (filename, e))
+        if (len(infos) != 1 or
+            infos[0].file_size not in (1201 * 1201 * 2, 3601 * 3601 * 2)):
+            raise IOError("Error downloading %s: not an SRTM tile" % filename)
 
 
 class SRTMTile:
@@ -245,23 +415,54 @@ class SRTMTile:
         This means there is a 1 pixel overlap between tiles. This makes it
         easier for as to interpolate the value, because for every point we
         only have to look at a single tile.
+
+        The samples are uncompressed once into a file next to the zip
+        (.hgt.native), in the byte order of the machine, which is then
+        memory mapped.
         """
+    sample = struct.Struct("h")
+
     def __init__(self, f, lat, lon):
+        self.lat = lat
+        self.lon = lon
+        native = os.path.splitext(f)[0] + ".native"
+        if (not os.path.exists(native) or
+            os.path.getmtime(native) < os.path.getmtime(f)):
+            self._writeNative(f, native)
+        data = open(native, 'rb')
+        try:
+            length = os.fstat(data.fileno()).st_size
+            self.size = int(math.sqrt(length/2)) # 2 bytes per sample
+            # Currently only SRTM1/3 is supported
+            if (self.size not in (1201, 3601) or
+                length != self.size * self.size * 2):
+                raise InvalidTileError(lat, lon)
+            self.data = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            data.close()
+
+    def _writeNative(self, f, native):
+        """Uncompress the (big endian) samples of the zip into native."""
         zipf = zipfile.ZipFile(f, 'r')
         names = zipf.namelist()
         if len(names) != 1:
-            raise InvalidTileError(lat, lon)
-        data = zipf.read(names[0])
-        self.size = int(math.sqrt(len(data)/2)) # 2 bytes per sample
-        # Currently only SRTM1/3 is supported
-        if self.size not in (1201, 3601):
-            raise InvalidTileError(lat, lon)
-        self.data = array.array('h', data)
-        self.data.byteswap()
-        if len(self.data) != self.size * self.size:
-            raise InvalidTileError(lat, lon)
-        self.lat = lat
-        self.lon = lon
+            raise InvalidTileError(self.lat, self.lon)
+        data = array.array('h', zipf.read(names[0]))
+        zipf.close()
+        if sys.byteorder == "little":
+            data.byteswap()
+        temp = "%s.%d.%d" % (native, os.getpid(),
+            threading.current_thread().ident)
+        output = open(temp, 'wb')
+        try:
+            data.tofile(output)
+        finally:
+            output.close()
+        os.rename(temp, native)
+
+    def getDataSize(self):
+        """Size of the samples in bytes."""
+        return len(self.data)
 
     @staticmethod
     def _avg(value1, value2, weight):
@@ -303,7 +504,7 @@ class SRTMTile:
         # Same as calcOffset, inlined for performance reasons
         offset = x + self.size * (self.size - y - 1)
         #print offset
-        value = self.data[offset]
+        value = self.sample.unpack_from(self.data, offset * 2)[0]
         if value == -32768:
             return None # -32768 is a special value for areas with no data
         return value
@@ -338,6 +539,42 @@ class SRTMTile:
         #        value00, value10, value1, value01, value11, value2, value)
         return value
 
+    @staticmethod
+    def _avgArrays(values1, values2, weights):
+        """Same as _avg on arrays, NaN standing for None."""
+        result = values2 * weights + values1 * (1 - weights)
+        result = numpy.where(numpy.isnan(values1), values2, result)
+        return numpy.where(numpy.isnan(values2), values1, result)
+
+    def getAltitudes(self, lats, lons):
+        """Get the altitudes of arrays of lat lon pairs in this tile, as
+            getAltitudeFromLatLon does for a single pair. Points without
+            data get NaN. Requires numpy."""
+        lats = numpy.asarray(lats, dtype=numpy.float64) - self.lat
+        lons = numpy.asarray(lons, dtype=numpy.float64) - self.lon
+        outside = (lats < 0.0) | (lats >= 1.0) | (lons < 0.0) | (lons >= 1.0)
+        if outside.any():
+            i = numpy.flatnonzero(outside)[0]
+            raise WrongTileError(self.lat, self.lon,
+                self.lat+lats[i], self.lon+lons[i])
+        # Rows go from north to south, see calcOffset.
+        samples = numpy.frombuffer(self.data, dtype=numpy.int16).reshape(
+            self.size, self.size)[::-1]
+        x = lons * (self.size - 1)
+        y = lats * (self.size - 1)
+        x_int = x.astype(int)
+        x_frac = x - x_int
+        y_int = y.astype(int)
+        y_frac = y - y_int
+        values = []
+        for dx, dy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            value = samples[y_int + dy, x_int + dx].astype(numpy.float64)
+            value[value == -32768] = numpy.nan
+            values.append(value)
+        value00, value10, value01, value11 = values
+        value1 = self._avgArrays(value00, value10, x_frac)
+        value2 = self._avgArrays(value01, value11, x_frac)
+        return self._avgArrays(value1, value2, y_frac)
 
 
 class parseHTMLDirectoryListing(HTMLParser):